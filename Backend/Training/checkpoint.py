@@ -0,0 +1,121 @@
+"""Resumable training checkpoints written in the background.
+
+A checkpoint holds everything needed to continue a run mid-epoch: model, optimizer, scaler and
+scheduler state, the RNG state of every rank and the (epoch, step) position in the sampler.
+"""
+import glob
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data.distributed import DistributedSampler
+
+
+def to_cpu(state):
+    """Detached CPU copy of a (nested) state dict, safe to write while training keeps updating the original."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+
+def rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """DistributedSampler that can start an epoch after the samples a checkpoint already consumed."""
+
+    def __init__(self, dataset, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.start_index = 0
+
+    def set_start(self, start_index):
+        """Skip the first start_index samples of this rank's share of the epoch."""
+        self.start_index = start_index
+
+    def __iter__(self):
+        # Same permutation as the full epoch (seeded by epoch), minus the samples already trained on
+        indices = list(super().__iter__())[self.start_index:]
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+
+class CheckpointManager:
+    """Writes checkpoints from a background thread with atomic renames, keeping the last keep_last.
+
+    Files are checkpoint_e{epoch}_s{step}.pt in directory. save() copies the state to CPU on the
+    caller's thread (so training can continue mutating the tensors) and returns before it is on disk;
+    a new save waits for the previous write first.
+    """
+
+    def __init__(self, directory, keep_last=3):
+        if keep_last < 1:
+            raise ValueError(f"keep_last must be at least 1, got {keep_last}: the latest checkpoint is what training resumes from")
+        self.directory = directory
+        self.keep_last = keep_last
+        self._thread = None
+        self._error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _write(self, state, path, inference_path):
+        try:
+            tmp = path + ".tmp"
+            torch.save(state, tmp)
+            os.replace(tmp, path)  # a crash mid-write never leaves a truncated checkpoint behind
+            if inference_path:
+                tmp = inference_path + ".tmp"
+                torch.save({"MODEL_STATE": state["MODEL_STATE"]}, tmp)
+                os.replace(tmp, inference_path)
+            for old in self.checkpoints()[:-self.keep_last]:
+                os.remove(old)
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        """Block until the pending write (if any) is on disk; re-raise its error."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, state, epoch, step, inference_path=None):
+        """Start writing state; inference_path optionally also gets the model weights alone."""
+        self.wait()
+        state = to_cpu(state)
+        path = os.path.join(self.directory, f"checkpoint_e{epoch:04d}_s{step:08d}.pt")
+        self._thread = threading.Thread(target=self._write, args=(state, path, inference_path), daemon=True)
+        self._thread.start()
+        return path
+
+    def checkpoints(self):
+        # Zero-padded epoch/step sort chronologically by name
+        return sorted(glob.glob(os.path.join(self.directory, "checkpoint_e*_s*.pt")))
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
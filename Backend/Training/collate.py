@@ -0,0 +1,191 @@
+"""Batch collators for pretraining.
+
+    python collate.py data/pretokenized --batch_size 32     # padding ratio with and without packing
+"""
+import numpy as np
+import torch
+from torch.utils.data import default_collate
+
+
+def pack_lengths(lengths, max_length):
+    """First-fit decreasing: group sequence lengths into rows of at most max_length tokens.
+
+    Returns a list of rows, each a list of indices into lengths.
+    """
+    rows, free = [], []
+    for i in np.argsort(-np.asarray(lengths), kind="stable"):
+        for r, space in enumerate(free):
+            if lengths[i] <= space:
+                rows[r].append(int(i))
+                free[r] -= lengths[i]
+                break
+        else:
+            rows.append([int(i)])
+            free.append(max_length - lengths[i])
+    return rows
+
+
+class PackingCollator:
+    """Packs several documents into each row instead of padding every document to max_length.
+
+    Every document's positions restart at 0 and it gets its own segment id, which NepaliTransformer
+    turns into a block-diagonal attention mask so documents don't attend to each other. Padding is
+    segment 0.
+
+    Accepts items from PretokenizedDataset (raw ids, CLS/SEP added here) or already encoded items
+    with ``attention_mask`` and ``labels``, whose padding is stripped and whose labels are packed
+    along. Whole documents keep their own CLS/SEP. A packed window with ``doc_starts`` becomes one
+    row, CLS + window + SEP, split into segments where documents start: only the first segment
+    has a CLS and only the last a SEP, since a window has no room for a pair per document.
+
+    With pack=False every document gets a row of its own, padded to the longest row of the batch;
+    this is how raw PretokenizedDataset documents are batched without packing.
+
+    Each batch carries ``token_counts`` = [real tokens, tokens if padded to max_length, tokens after
+    packing], so the padding ratio can be reported from the training loop even with worker processes.
+    """
+
+    def __init__(self, cls_token_id, sep_token_id, pad_token_id, max_length=512, pack=True):
+        self.cls_token_id = cls_token_id
+        self.sep_token_id = sep_token_id
+        self.pad_token_id = pad_token_id
+        self.max_length = max_length
+        self.pack = pack
+
+    def _segments(self, item):
+        """Split an item into (ids, labels or None) per document, special tokens included."""
+        ids = np.asarray(item["input_ids"])
+        if "attention_mask" in item:
+            length = int(np.asarray(item["attention_mask"]).sum())
+            labels = np.asarray(item["labels"])[:length] if "labels" in item else None
+            return [(ids[:length], labels)]
+
+        ids = ids[:self.max_length - 2]
+        starts = [0] + [int(s) for s in item.get("doc_starts", ())] + [len(ids)]
+        if len(starts) == 2:
+            return [(np.concatenate(([self.cls_token_id], ids, [self.sep_token_id])), None)]
+        # A packed window becomes one row: CLS + window + SEP, split where documents start
+        row = np.concatenate(([self.cls_token_id], ids, [self.sep_token_id]))
+        bounds = [0] + [s + 1 for s in starts[1:-1]] + [len(row)]
+        return [(row[a:b], None) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def __call__(self, batch):
+        items = [self._segments(item) for item in batch]
+        with_labels = any(labels is not None for segments in items for _, labels in segments)
+
+        # Windows are rows already; whole documents are bin-packed into rows
+        rows = [segments for segments in items if len(segments) > 1]
+        docs = [segments[0] for segments in items if len(segments) == 1]
+        if self.pack:
+            rows += [[docs[i] for i in group] for group in pack_lengths([len(ids) for ids, _ in docs], self.max_length)]
+        else:
+            rows += [[doc] for doc in docs]
+
+        width = max(sum(len(ids) for ids, _ in row) for row in rows)
+        input_ids = np.full((len(rows), width), self.pad_token_id, dtype=np.int64)
+        position_ids = np.zeros((len(rows), width), dtype=np.int64)
+        segment_ids = np.zeros((len(rows), width), dtype=np.int64)
+        labels = np.full((len(rows), width), -100, dtype=np.int64)
+        for r, row in enumerate(rows):
+            offset = 0
+            for s, (ids, doc_labels) in enumerate(row, start=1):
+                end = offset + len(ids)
+                input_ids[r, offset:end] = ids
+                position_ids[r, offset:end] = np.arange(len(ids))
+                segment_ids[r, offset:end] = s
+                if doc_labels is not None:
+                    labels[r, offset:end] = doc_labels
+                offset = end
+
+        real_tokens = int((segment_ids > 0).sum())
+        output = {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy((segment_ids > 0).astype(np.int64)),
+            "position_ids": torch.from_numpy(position_ids),
+            "segment_ids": torch.from_numpy(segment_ids),
+            "token_counts": torch.tensor([real_tokens, len(batch) * self.max_length, input_ids.size]),
+        }
+        if with_labels:
+            output["labels"] = torch.from_numpy(labels)
+        return output
+
+
+class MLMCollator:
+    """BERT masking applied per batch, so every epoch sees a different masking pattern.
+
+    Wraps another collate function (default_collate or PackingCollator) and replaces its labels:
+    mlm_probability of the non-special tokens are selected; 80% of those become <mask>, 10% a random
+    token and 10% stay unchanged. Labels hold the original id at selected positions and -100 elsewhere.
+    Precomputed labels from the wrapped batch are only used to restore the unmasked input ids.
+    """
+
+    def __init__(self, mask_token_id, vocab_size, special_token_ids, mlm_probability=0.15, collate_fn=None):
+        self.mask_token_id = mask_token_id
+        self.vocab_size = vocab_size
+        self.special_token_ids = torch.tensor(sorted(special_token_ids))
+        # Random replacements are drawn from the regular vocabulary after the special tokens
+        self.first_regular_id = int(self.special_token_ids.max()) + 1
+        self.mlm_probability = mlm_probability
+        self.collate_fn = collate_fn or default_collate
+
+    def mask_tokens(self, input_ids):
+        """Return (masked input_ids, labels) for a (batch, seq_len) tensor of token ids."""
+        input_ids = input_ids.clone()
+        probability = torch.full(input_ids.shape, self.mlm_probability)
+        probability.masked_fill_(torch.isin(input_ids, self.special_token_ids), 0.0)
+        selected = torch.bernoulli(probability).bool()
+        if not selected.any() and probability.any():
+            # A batch of short documents can draw no position at all; the loss over an empty target
+            # set is NaN, so one candidate position is always selected
+            selected.view(-1)[torch.multinomial(probability.view(-1), 1)] = True
+        labels = torch.where(selected, input_ids, -100)
+
+        draw = torch.rand(input_ids.shape)
+        input_ids[selected & (draw < 0.8)] = self.mask_token_id
+        replaced = selected & (draw >= 0.8) & (draw < 0.9)
+        input_ids[replaced] = torch.randint(self.first_regular_id, self.vocab_size, (int(replaced.sum()),), dtype=input_ids.dtype)
+        return input_ids, labels
+
+    def __call__(self, batch):
+        output = self.collate_fn(batch)
+        input_ids = output["input_ids"].long()
+        if "labels" in output:
+            input_ids = torch.where(output["labels"] != -100, output["labels"], input_ids)
+        output["input_ids"], output["labels"] = self.mask_tokens(input_ids)
+        return output
+
+
+def padding_report(token_counts):
+    """Padding ratios from summed ``token_counts`` of PackingCollator batches."""
+    real, padded, packed = (int(c) for c in token_counts)
+    return {
+        "real_tokens": real,
+        "padding_ratio_unpacked": 1 - real / padded if padded else 0.0,
+        "padding_ratio_packed": 1 - real / packed if packed else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import os
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from dataset import PretokenizedDataset
+
+    parser = argparse.ArgumentParser(description="Padding ratio of a pre-tokenized corpus before and after packing")
+    parser.add_argument("data_dir")
+    parser.add_argument("--max_length", default=512, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    args = parser.parse_args()
+
+    dataset = PretokenizedDataset(args.data_dir, max_length=args.max_length)
+    lengths = dataset.lengths() + 2  # CLS and SEP
+    counts = np.zeros(3, dtype=np.int64)
+    for start in range(0, len(lengths), args.batch_size):
+        batch = lengths[start:start + args.batch_size]
+        rows = pack_lengths(batch, args.max_length)
+        width = max(int(batch[row].sum()) for row in rows)
+        counts += [batch.sum(), len(batch) * args.max_length, len(rows) * width]
+    for name, value in padding_report(counts).items():
+        print(f"{name}: {value:.4f}" if isinstance(value, float) else f"{name}: {value}")
@@ -0,0 +1,97 @@
+"""Smoke benchmark of the gloo/CPU training path on synthetic data.
+
+    python cpu_benchmark.py --nprocs 1 2 4
+
+For every process count, trains a small NepaliTransformer through the same Trainer as multigpu.py
+(one warmup epoch, one timed epoch) and reports tokens/sec over all processes.
+"""
+import argparse
+import json
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.distributed import destroy_process_group
+from torch.utils.data import Dataset
+
+from collate import MLMCollator
+from model import NepaliTransformer
+from multigpu import Trainer, ddp_setup, prepare_dataloader
+from quantize import bf16_supported
+
+
+class SyntheticDataset(Dataset):
+    """Fixed-length random token sequences, the same for a given index in every process."""
+
+    def __init__(self, num_samples, seq_len, vocab_size):
+        self.num_samples = num_samples
+        self.seq_len = seq_len
+        self.vocab_size = vocab_size
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        generator = torch.Generator().manual_seed(idx)
+        input_ids = torch.randint(5, self.vocab_size, (self.seq_len,), generator=generator)
+        input_ids[0], input_ids[-1] = 2, 3  # <cls>, <sep>
+        return {"input_ids": input_ids, "attention_mask": torch.ones(self.seq_len, dtype=torch.long)}
+
+
+def run(rank, world_size, args, port):
+    import os
+    os.environ["MASTER_PORT"] = str(port)
+    ddp_setup(rank, world_size, backend="gloo")
+    torch.manual_seed(0)
+
+    model = NepaliTransformer(args.vocab_size, args.d_model, args.seq_len, args.num_layers, args.num_heads)
+    model.cls_head.requires_grad_(False)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+    dataset = SyntheticDataset(args.steps * args.batch_size * world_size, args.seq_len, args.vocab_size)
+    collate_fn = MLMCollator(4, args.vocab_size, [0, 1, 2, 3, 4])
+    data = prepare_dataloader(dataset, args.batch_size, collate_fn, num_workers=0, pin_memory=False)
+
+    amp = args.bf16 and bf16_supported("cpu")
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        trainer = Trainer(model, data, data, optimizer, None, rank, checkpoint_dir=checkpoint_dir,
+                          device=torch.device("cpu"), amp=amp, telemetry_path=args.telemetry)
+        trainer._run_epoch(0)  # warmup
+        dist.barrier()
+        start = time.perf_counter()
+        trainer._run_epoch(1)
+        dist.barrier()
+        elapsed = time.perf_counter() - start
+        if trainer.telemetry:
+            trainer.telemetry.close()
+
+    if rank == 0:
+        tokens = len(dataset) * args.seq_len
+        print(json.dumps({
+            "nprocs": world_size,
+            "threads_per_proc": torch.get_num_threads(),
+            "bf16_autocast": amp,
+            "tokens_per_sec": round(tokens / elapsed, 1),
+            "step_time_ms": round(1000 * elapsed / args.steps, 1),
+        }))
+    destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tokens/sec of CPU (gloo) training for several process counts")
+    parser.add_argument("--nprocs", default=[1, 2], type=int, nargs="+")
+    parser.add_argument("--steps", default=10, type=int, help="Timed optimizer steps per process")
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--seq_len", default=128, type=int)
+    parser.add_argument("--vocab_size", default=30000, type=int)
+    parser.add_argument("--d_model", default=256, type=int)
+    parser.add_argument("--num_layers", default=2, type=int)
+    parser.add_argument("--num_heads", default=4, type=int)
+    parser.add_argument("--telemetry", default=None, help="Also write per-step telemetry to this JSONL file")
+    parser.add_argument("--bf16", action="store_true", help="bf16 autocast (only used where the CPU supports it natively)")
+    args = parser.parse_args()
+
+    for i, nprocs in enumerate(args.nprocs):
+        # A fresh port per run, the previous one may still be in TIME_WAIT
+        mp.spawn(run, args=(nprocs, args, 12400 + i), nprocs=nprocs)
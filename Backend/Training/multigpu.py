@@ -4,27 +4,58 @@ from torch.utils.data import Dataset, DataLoader
 from torch.amp import GradScaler, autocast
 
 import torch.multiprocessing as mp
-from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed import init_process_group, destroy_process_group
+import torch.distributed as dist
+import math
 import os
+from contextlib import nullcontext
 
 
 from nepalitokenizer import NepaliTokenizer
-from chunkdataset import ChunkDataset
+from collate import MLMCollator, PackingCollator, padding_report
+from dataset import PretokenizedDataset
+from checkpoint import CheckpointManager, ResumableDistributedSampler, rng_state, set_rng_state
 from model import NepaliTransformer
+from quantize import bf16_supported
+from telemetry import StepTelemetry
 from tqdm.auto import tqdm
 
-def ddp_setup(rank, world_size):
+def ddp_setup(rank, world_size, backend="nccl"):
     """
     Args:
         rank: Unique identifier of each process
         world_size: Total number of processes
+        backend: "nccl" for one process per GPU, "gloo" for CPU processes
     """
-    os.environ["MASTER_ADDR"] = "localhost"
-    os.environ["MASTER_PORT"] = "12355"
-    torch.cuda.set_device(rank)
-    init_process_group(backend="nccl", rank=rank, world_size=world_size)
+    os.environ.setdefault("MASTER_ADDR", "localhost")
+    os.environ.setdefault("MASTER_PORT", "12355")
+    if backend == "nccl":
+        torch.cuda.set_device(rank)
+    else:
+        pin_cpu_threads(rank, world_size)
+    init_process_group(backend=backend, rank=rank, world_size=world_size)
+
+
+def pin_cpu_threads(rank, world_size):
+    """Give each CPU process its own block of cores and as many intra-op threads, so ranks don't oversubscribe."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    per_rank = max(1, len(cores) // world_size)
+    own = cores[rank * per_rank:(rank + 1) * per_rank] or cores
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, own)
+    torch.set_num_threads(len(own))
+    torch.set_num_interop_threads(1)
+
+def warmup_cosine_schedule(optimizer, warmup_steps, total_steps, min_lr_ratio=0.0):
+    """Linear warmup to the optimizer's lr, then cosine annealing down to min_lr_ratio * lr."""
+    def lr_lambda(step):
+        if step < warmup_steps:
+            return (step + 1) / warmup_steps
+        progress = min(1.0, (step - warmup_steps) / max(1, total_steps - warmup_steps))
+        return min_lr_ratio + (1 - min_lr_ratio) * 0.5 * (1 + math.cos(math.pi * progress))
+    return torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda)
+
 
 class Trainer:
     def __init__(
@@ -36,83 +67,161 @@ class Trainer:
         tokenizer:any,
         gpu_id: int,
         save_every= 1,
-        # snapshot_path: str,
+        grad_accum_steps: int = 1,
+        max_grad_norm: float = None,
+        scheduler=None,
+        checkpoint_dir: str = 'checkpoints',
+        checkpoint_every: int = 0,
+        keep_last: int = 3,
+        inference_path: str = None,
+        device: torch.device = None,
+        amp: bool = True,
+        telemetry_path: str = None,
     ) -> None:
         print('la ya ta print huuu')
         self.gpu_id = gpu_id
-        self.model =  model.to(torch.device(self.gpu_id))
+        self.device = device or torch.device(f"cuda:{gpu_id}")
+        # fp16 autocast with loss scaling on GPU; bf16 on CPU, which has the fp32 range and needs no scaler
+        self.amp = amp
+        self.amp_dtype = torch.float16 if self.device.type == "cuda" else torch.bfloat16
+        self.model =  model.to(self.device)
         print(self.model)
         self.train_data = train_data
         self.valid_data = valid_data
         self.optimizer = optimizer
         self.tokenizer = tokenizer
-        self.scaler = GradScaler()
+        self.scaler = GradScaler(self.device.type, enabled=amp and self.amp_dtype == torch.float16)
         self.criterion = torch.nn.CrossEntropyLoss(ignore_index=-100)
         self.save_every = save_every
+        self.grad_accum_steps = grad_accum_steps
+        self.max_grad_norm = max_grad_norm
+        self.scheduler = scheduler
         self.epochs_run = 0
-        self.snapshot_path = 'snapshot.pt'
-        # if os.path.exists(snapshot_path):
-        #     print("Loading snapshot")
-        #     self._load_snapshot(snapshot_path)
+        self.start_step = 0  # micro-batches of epochs_run already trained on when resuming mid-epoch
+        self.global_step = 0  # optimizer steps
+        self.checkpoint_every = checkpoint_every  # optimizer steps between mid-epoch checkpoints, 0 = epoch ends only
+        self.inference_path = inference_path
+        self.checkpoints = CheckpointManager(checkpoint_dir, keep_last)
         print('suru ko hai trainer')
 
-        self.model = DDP(self.model, device_ids=[self.gpu_id])
+        self.model = DDP(self.model, device_ids=[self.gpu_id] if self.device.type == "cuda" else None)
+        self.telemetry = None
+        if telemetry_path:
+            self.telemetry = StepTelemetry(telemetry_path, gpu_id, self.device)
+            self.model.register_comm_hook(None, self.telemetry.allreduce_hook)
+        latest = self.checkpoints.latest()
+        if latest:
+            print("Loading snapshot")
+            self._load_snapshot(latest)
 
     def _load_snapshot(self, snapshot_path):
-        loc = f"cuda:{self.gpu_id}"
-        snapshot = torch.load(snapshot_path, map_location=loc)
-        self.model.load_state_dict(snapshot["MODEL_STATE"])
+        snapshot = torch.load(snapshot_path, map_location="cpu", weights_only=False)
+        self.model.module.load_state_dict(snapshot["MODEL_STATE"])
         self.optimizer.load_state_dict(snapshot["OPTIMIZER_STATE"])
 
         if self.scaler is not None and 'SCALER_STATE' in snapshot:
             self.scaler.load_state_dict(snapshot["SCALER_STATE"])
+        if self.scheduler is not None and 'SCHEDULER_STATE' in snapshot:
+            self.scheduler.load_state_dict(snapshot["SCHEDULER_STATE"])
         self.epochs_run = snapshot["EPOCHS_RUN"]
-        print(f"Resuming training from snapshot at Epoch {self.epochs_run}")
+        self.start_step = snapshot.get("STEP", 0)
+        self.global_step = snapshot.get("GLOBAL_STEP", 0)
+        if 'RNG_STATES' in snapshot:
+            rng_states = snapshot["RNG_STATES"]
+            set_rng_state(rng_states[dist.get_rank()] if dist.get_rank() < len(rng_states) else rng_states[0])
+        print(f"Resuming training from snapshot at Epoch {self.epochs_run} Step {self.start_step}")
 
-    def _run_batch(self,input_ids,attention_mask,labels):
-        with autocast(f"cuda:{self.gpu_id}"):
-            output = self.model(input_ids,attention_mask=attention_mask)
-            loss = self.criterion(output.view(-1, self.tokenizer.tokenizer.get_vocab_size()), labels.view(-1))
+    def _run_batch(self,input_ids,attention_mask,labels,position_ids=None,segment_ids=None):
+        with autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp):
+            # lm_head and the loss only run on the masked positions, not on every token of the batch
+            positions = (labels != -100).nonzero()
+            logits = self.model(input_ids,attention_mask=attention_mask,position_ids=position_ids,
+                                segment_ids=segment_ids,lm_positions=positions)
+            loss = self.criterion(logits.float(), labels[positions[:, 0], positions[:, 1]])
         return loss
 
     def _run_epoch(self, epoch):
         self.model.train()
-        b_sz = len(next(iter(self.train_data))[0])
-        print(f"[GPU{self.gpu_id}] Epoch {epoch} | Batchsize: {b_sz} | Steps: {len(self.train_data)}")
-        total_train_loss = 0
+        b_sz = self.train_data.batch_size
+        # Resuming mid-epoch: the sampler skips what the checkpoint already trained on
+        start_step = self.start_step if epoch == self.epochs_run else 0
         self.train_data.sampler.set_epoch(epoch)
-        train_bar = tqdm(self.train_data)
-        for batch in train_bar:
-            input_ids = batch['input_ids'].to(self.gpu_id)
-            attention_mask = batch['attention_mask'].to(self.gpu_id)
-            labels = batch['labels'].to(self.gpu_id)
-
-            self.optimizer.zero_grad()
-            loss = self._run_batch(input_ids,attention_mask,labels)
-            self.scaler(loss).backward()
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
+        self.train_data.sampler.set_start(start_step * b_sz)
+        num_steps = start_step + len(self.train_data)
+        print(f"[GPU{self.gpu_id}] Epoch {epoch} | Batchsize: {b_sz} x {self.grad_accum_steps} accumulated | Steps: {num_steps}")
+        total_train_loss = 0
+        token_counts = torch.zeros(3, dtype=torch.long)
+        train_bar = tqdm(self.train_data, initial=start_step, total=num_steps)
+        self.optimizer.zero_grad(set_to_none=True)
+        telemetry = self.telemetry
+        if telemetry:
+            telemetry.start()
+        for step, batch in enumerate(train_bar, start=start_step):
+            input_ids = batch['input_ids'].to(self.device)
+            attention_mask = batch['attention_mask'].to(self.device)
+            labels = batch['labels'].to(self.device)
+            # Only present with the packing collator
+            position_ids = batch['position_ids'].to(self.device) if 'position_ids' in batch else None
+            segment_ids = batch['segment_ids'].to(self.device) if 'segment_ids' in batch else None
+            if 'token_counts' in batch:
+                token_counts += batch['token_counts']
+            if telemetry:
+                telemetry.tokens += int(attention_mask.sum())
+                telemetry.mark("data_wait")
+
+            # Gradients are only all-reduced on the last micro-batch of each accumulation window
+            update = (step + 1) % self.grad_accum_steps == 0 or step + 1 == num_steps
+            with nullcontext() if update else self.model.no_sync():
+                loss = self._run_batch(input_ids,attention_mask,labels,position_ids,segment_ids)
+                if telemetry:
+                    telemetry.mark("forward")
+                self.scaler.scale(loss / self.grad_accum_steps).backward()
+                if telemetry:
+                    telemetry.mark("backward")
+            if update:
+                if self.max_grad_norm:
+                    self.scaler.unscale_(self.optimizer)
+                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad(set_to_none=True)
+                lr = self.optimizer.param_groups[0]["lr"]
+                if self.scheduler is not None:
+                    self.scheduler.step()
+                self.global_step += 1
+                if telemetry:
+                    telemetry.mark("optimizer")
+                    telemetry.record(self.global_step, loss.item(), lr)
+                if self.checkpoint_every and self.global_step % self.checkpoint_every == 0 and step + 1 < num_steps:
+                    self._save_snapshot(epoch, step + 1)
             train_bar.set_postfix(
                 {
                     "loss":f"{loss.item():.4f}"
                 }
             )
             total_train_loss += loss.item()
+        if token_counts.any():
+            report = padding_report(token_counts)
+            print(f"[GPU{self.gpu_id}] Epoch {epoch} | Padding {report['padding_ratio_unpacked']:.1%} unpacked"
+                  f" -> {report['padding_ratio_packed']:.1%} packed")
         return total_train_loss
 
     def _valid_epoch(self,epoch):
         self.model.eval()
-        b_sz = len(next(iter(self.valid_data))[0])
-        print(f"[GPU{self.gpu_id}] Epoch {epoch} | Batchsize: {b_sz} | Steps: {len(self.train_data)}")
+        b_sz = self.valid_data.batch_size
+        print(f"[GPU{self.gpu_id}] Epoch {epoch} | Batchsize: {b_sz} | Steps: {len(self.valid_data)}")
         total_valid_loss = 0
         self.valid_data.sampler.set_epoch(epoch)
         valid_bar = tqdm(self.valid_data)
         for batch in valid_bar:
-            input_ids = batch['input_ids'].to(self.gpu_id)
-            attention_mask = batch['attention_mask'].to(self.gpu_id)
-            labels = batch['labels'].to(self.gpu_id)
+            input_ids = batch['input_ids'].to(self.device)
+            attention_mask = batch['attention_mask'].to(self.device)
+            labels = batch['labels'].to(self.device)
+            position_ids = batch['position_ids'].to(self.device) if 'position_ids' in batch else None
+            segment_ids = batch['segment_ids'].to(self.device) if 'segment_ids' in batch else None
 
-            loss = self._run_batch(input_ids,attention_mask,labels)
+            with torch.no_grad():
+                loss = self._run_batch(input_ids,attention_mask,labels,position_ids,segment_ids)
             valid_bar.set_postfix(
                 {
                     "loss":f"{loss.item():.4f}"
@@ -121,16 +230,28 @@ class Trainer:
             total_valid_loss += loss.item()        
         return total_valid_loss
 
-    def _save_snapshot(self, epoch):
+    def _save_snapshot(self, epoch, step=0):
+        """Checkpoint the position (epoch, step) to resume from. Called on every rank, written by rank 0."""
+        # Every rank's RNG state, so a resumed run draws the same masks and dropout
+        rng_states = [None] * dist.get_world_size()
+        dist.all_gather_object(rng_states, rng_state())
+        if dist.get_rank() != 0:
+            return
         snapshot = {
             "MODEL_STATE": self.model.module.state_dict(),
             "EPOCHS_RUN": epoch,
-            "OPTIMIZER_STATE": self.optimizer.state_dict()
+            "STEP": step,
+            "GLOBAL_STEP": self.global_step,
+            "OPTIMIZER_STATE": self.optimizer.state_dict(),
+            "RNG_STATES": rng_states,
         }
         if self.scaler is not None:
             snapshot['SCALER_STATE'] = self.scaler.state_dict()
-        torch.save(snapshot, self.snapshot_path)
-        print(f"Epoch {epoch} | Training snapshot saved at {self.snapshot_path}")
+        if self.scheduler is not None:
+            snapshot['SCHEDULER_STATE'] = self.scheduler.state_dict()
+        # Copied to CPU here, written to disk in the background while training continues
+        path = self.checkpoints.save(snapshot, epoch, step, self.inference_path)
+        print(f"Epoch {epoch} Step {step} | Training snapshot saving to {path}")
 
     def train(self, max_epochs: int):
         history ={
@@ -139,48 +260,90 @@ class Trainer:
         }
         for epoch in range(self.epochs_run, max_epochs):
             history['train_loss'].append(self._run_epoch(epoch))
-            if self.gpu_id == 0 and epoch % self.save_every == 0:
-                self._save_snapshot(epoch)
+            self.start_step = 0
+            if epoch % self.save_every == 0:
+                self._save_snapshot(epoch + 1)
             history['valid_loss'].append(self._valid_epoch(epoch))
+        self.checkpoints.wait()
+        if self.telemetry:
+            self.telemetry.close()
 
 
-def load_train_objs():
-    lr = 5e-5
+def load_train_objs(gradient_checkpointing=False, lr=5e-5, optimizer_impl="auto", device_type="cuda",
+                    data_dir=None, packed=False):
     d_model=768
     max_len=512
     num_layers=6
     num_heads=8
     tokenizer = NepaliTokenizer(load_path = 'nepali_tokenizer.json')
     vocab_size=tokenizer.tokenizer.get_vocab_size()
-    dataset = ChunkDataset(tokenizer,metadata_path='metadata.json')
+    if data_dir:
+        # Shards written by pretokenize.py, memory-mapped once per worker: no tokenizing or file opening per item
+        dataset = PretokenizedDataset(data_dir, max_length=max_len, packed=packed)
+    else:
+        from chunkdataset import ChunkDataset  # not needed by callers that bring their own data
+        dataset = ChunkDataset(tokenizer,metadata_path='metadata.json')
     model = NepaliTransformer(vocab_size,d_model,max_len,num_layers,num_heads)
-    optimizer = torch.optim.AdamW(model.parameters(),lr=lr)
+    # cls_head takes no part in the MLM loss; DDP requires every trainable parameter to get a gradient
+    model.cls_head.requires_grad_(False)
+    model.gradient_checkpointing = gradient_checkpointing
+    # fused: one kernel for the whole update, foreach: one kernel per op over all tensors, for-loop: per tensor
+    if optimizer_impl == "auto":
+        optimizer_impl = "fused" if device_type == "cuda" else "foreach"
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad],lr=lr,
+                                  fused=optimizer_impl == "fused", foreach=optimizer_impl == "foreach")
     return dataset, tokenizer, model, optimizer
 
 
-def prepare_dataloader(dataset: Dataset, batch_size: int):
+def prepare_dataloader(dataset: Dataset, batch_size: int, collate_fn=None, num_workers: int = 4, pin_memory: bool = True):
     return DataLoader(
         dataset,
         batch_size=batch_size,
-        num_workers = 4,
-        pin_memory=True,
+        num_workers = num_workers,
+        pin_memory=pin_memory,
         shuffle=False,
-        sampler=DistributedSampler(dataset)
+        sampler=ResumableDistributedSampler(dataset),
+        collate_fn=collate_fn
     )
 
 
-def main(rank: int,world_size: int,save_every: int, total_epochs: int, batch_size: int):
-    ddp_setup(rank,world_size)
-    dataset, tokenizer, model, optimizer = load_train_objs()
+def main(rank: int, world_size: int, args):
+    ddp_setup(rank, world_size, args.backend)
+    cpu = args.backend == "gloo"
+    device = torch.device("cpu") if cpu else torch.device(f"cuda:{rank}")
+    # bf16 autocast only pays off on CPUs with native bf16 (AVX512-BF16/AMX); fp32 otherwise
+    amp = not cpu or bf16_supported("cpu")
+    dataset, tokenizer, model, optimizer = load_train_objs(args.gradient_checkpointing, args.lr, args.optimizer_impl,
+                                                           device.type, args.data_dir, packed=args.pack)
     train_dataset, valid_dataset, test_dataset = dataset.split(
         train_ratio=0.8,  # 80% training
         valid_ratio=0.1,  # 10% validation
         seed=42  # For reproducibility
     )
-    train_data = prepare_dataloader(train_dataset, batch_size)
-    valid_data = prepare_dataloader(valid_dataset,batch_size)
-    trainer = Trainer(model, train_data,valid_data, optimizer, tokenizer, save_every)
-    trainer.train(total_epochs)
+    collate_fn = None
+    if args.data_dir:
+        # Raw token ids: the collator adds CLS/SEP and pads; with --pack the items are already full
+        # windows of the token stream, split into segments where documents start
+        collate_fn = PackingCollator(tokenizer.cls_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id,
+                                     max_length=512, pack=args.pack)
+    elif args.pack:
+        # Several documents per 512-token row instead of one padded document
+        collate_fn = PackingCollator(tokenizer.cls_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id, max_length=512)
+    if not args.static_masking:
+        special_token_ids = [tokenizer.pad_token_id, tokenizer.cls_token_id, tokenizer.sep_token_id,
+                             tokenizer.mask_token_id, tokenizer.tokenizer.token_to_id("<unk>")]
+        collate_fn = MLMCollator(tokenizer.mask_token_id, tokenizer.get_vocab_size(), special_token_ids,
+                                 collate_fn=collate_fn)
+    train_data = prepare_dataloader(train_dataset, args.batch_size, collate_fn, args.num_workers, pin_memory=not cpu)
+    valid_data = prepare_dataloader(valid_dataset, args.batch_size, collate_fn, args.num_workers, pin_memory=not cpu)
+    total_steps = args.total_epochs * math.ceil(len(train_data) / args.grad_accum_steps)
+    scheduler = warmup_cosine_schedule(optimizer, int(args.warmup_ratio * total_steps), total_steps, args.min_lr_ratio)
+    trainer = Trainer(model, train_data,valid_data, optimizer, tokenizer, rank, args.save_every,
+                      grad_accum_steps=args.grad_accum_steps, max_grad_norm=args.max_grad_norm,
+                      checkpoint_dir=args.checkpoint_dir, checkpoint_every=args.checkpoint_every,
+                      keep_last=args.keep_last, inference_path=args.inference_path, device=device, amp=amp,
+                      scheduler=scheduler, telemetry_path=args.telemetry)
+    trainer.train(args.total_epochs)
 
     destroy_process_group()
 
@@ -191,8 +354,29 @@ if __name__ == "__main__":
     parser.add_argument('--total_epochs',default=5, type=int, help='Total epochs to train the model')
     parser.add_argument('--save_every',default=1, type=int, help='How often to save a snapshot')
     parser.add_argument('--batch_size', default=32, type=int, help='Input batch size on each device (default: 32)')
-    # parser.add_argument('--snapshot_path', default="snapshot.pt", type=str, help='Path to save the snapshot')
+    parser.add_argument('--lr', default=5e-5, type=float, help='Peak learning rate')
+    parser.add_argument('--warmup_ratio', default=0.05, type=float, help='Share of the optimizer steps spent warming up linearly to --lr')
+    parser.add_argument('--min_lr_ratio', default=0.0, type=float, help='Cosine annealing ends at min_lr_ratio * lr')
+    parser.add_argument('--optimizer_impl', default='auto', choices=['auto', 'fused', 'foreach', 'for-loop'], help='AdamW implementation (auto: fused on GPU, foreach on CPU)')
+    parser.add_argument('--telemetry', default=None, help='Append per-step timing/throughput/memory records to this JSONL file')
+    parser.add_argument('--data_dir', default=None, help='Pre-tokenized shards written by pretokenize.py (default: ChunkDataset from metadata.json)')
+    parser.add_argument('--pack', action='store_true', help='Pack several documents into each sequence instead of padding')
+    parser.add_argument('--static_masking', action='store_true', help='Use the labels precomputed by the dataset instead of masking each batch')
+    parser.add_argument('--grad_accum_steps', default=1, type=int, help='Micro-batches per optimizer step (effective batch = batch_size x grad_accum_steps x GPUs)')
+    parser.add_argument('--max_grad_norm', default=None, type=float, help='Clip the gradient norm to this value')
+    parser.add_argument('--gradient_checkpointing', action='store_true', help='Recompute encoder layer activations in backward to save memory')
+    parser.add_argument('--backend', default='nccl', choices=['nccl', 'gloo'], help='nccl: one process per GPU, gloo: CPU processes')
+    parser.add_argument('--nprocs', default=None, type=int, help='Processes to start (default: one per GPU for nccl, 1 for gloo)')
+    parser.add_argument('--num_workers', default=4, type=int, help='DataLoader workers per process')
+    parser.add_argument('--checkpoint_dir', default='checkpoints', help='Where checkpoints are written and resumed from')
+    parser.add_argument('--checkpoint_every', default=0, type=int, help='Also checkpoint every N optimizer steps within an epoch (0: epoch ends only)')
+    parser.add_argument('--keep_last', default=3, type=int, help='Number of checkpoints to keep')
+    parser.add_argument('--inference_path', default=None, help='Also write the model weights alone here, e.g. models/snapshot.weights.pt for main.py')
     args = parser.parse_args()
+    if args.keep_last < 1:
+        parser.error('--keep_last must be at least 1')
+    if args.data_dir and args.static_masking:
+        parser.error('--static_masking needs the precomputed labels of ChunkDataset, not --data_dir')
 
-    world_size = torch.cuda.device_count()
-    mp.spawn(main, args=(world_size, args.save_every, args.total_epochs, args.batch_size), nprocs=world_size)
\ No newline at end of file
+    world_size = args.nprocs or (torch.cuda.device_count() if args.backend == 'nccl' else 1)
+    mp.spawn(main, args=(world_size, args), nprocs=world_size)
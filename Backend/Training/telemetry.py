@@ -0,0 +1,88 @@
+"""Per-step training telemetry written as JSON lines.
+
+Every optimizer step appends one record per rank:
+
+    {"rank": 0, "step": 120, "loss": 6.91, "lr": 4.9e-05, "tokens": 16384, "tokens_per_sec": 52133.0,
+     "step_time": 0.314, "data_wait": 0.002, "forward": 0.081, "backward": 0.196, "optimizer": 0.035,
+     "allreduce": 0.122, "peak_memory_mb": 9120.4}
+
+data_wait is the time spent waiting for the DataLoader (plus the host-to-device copy); a run whose
+data_wait is a large share of step_time is input-bound. forward/backward/optimizer are wall times
+with the device synchronised at each boundary. allreduce is the time DDP's gradient all-reduces were
+in flight; they overlap backward, so it is not part of the step_time sum. peak_memory_mb is the peak
+allocated CUDA memory of the step, or the peak RSS of the process on CPU.
+"""
+import json
+import resource
+import time
+
+import torch
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+PHASES = ("data_wait", "forward", "backward", "optimizer")
+
+
+class StepTelemetry:
+    def __init__(self, path, rank, device):
+        self.rank = rank
+        self.device = device
+        self._file = open(path, "a", buffering=1)  # one line per step, ranks append to the same file
+        self._reset()
+        self._last = time.perf_counter()
+
+    def _reset(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.allreduce = 0.0
+        self.tokens = 0
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def start(self):
+        """Restart the clock, e.g. before the DataLoader iterator is created for an epoch."""
+        self._last = time.perf_counter()
+
+    def mark(self, phase):
+        """Charge the time since the previous mark to phase."""
+        self._sync()
+        now = time.perf_counter()
+        self.times[phase] += now - self._last
+        self._last = now
+
+    def allreduce_hook(self, process_group, bucket):
+        """DDP comm hook: the default averaging all-reduce, timed until its future completes."""
+        start = time.perf_counter()
+
+        def done(fut):
+            self.allreduce += time.perf_counter() - start
+            return fut.value()
+
+        return default_hooks.allreduce_hook(process_group, bucket).then(done)
+
+    def record(self, step, loss, lr):
+        step_time = sum(self.times.values())
+        if self.device.type == "cuda":
+            peak_memory = torch.cuda.max_memory_allocated(self.device) / 2**20
+        else:
+            peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+        entry = {
+            "rank": self.rank,
+            "step": step,
+            "loss": loss,
+            "lr": lr,
+            "tokens": self.tokens,
+            "tokens_per_sec": self.tokens / step_time if step_time else 0.0,
+            "step_time": step_time,
+            **self.times,
+            "allreduce": self.allreduce,
+            "peak_memory_mb": peak_memory,
+            "time": time.time(),
+        }
+        self._file.write(json.dumps(entry) + "\n")
+        self._reset()
+
+    def close(self):
+        self._file.close()
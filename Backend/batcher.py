@@ -0,0 +1,150 @@
+import asyncio
+import time
+from collections import deque
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+class QueueFull(Exception):
+    """Raised by MicroBatcher.submit/submit_many when max_pending requests are already waiting."""
+
+
+class MicroBatcher:
+    """Gathers concurrent requests into one batch and runs a single forward pass for all of them.
+
+    Args:
+        process_batch: Function taking a list of request items and returning a list of results
+            in the same order. It runs in a worker thread so the event loop keeps accepting requests.
+        max_batch_size: Upper bound on the number of requests in one batch
+        max_wait_ms: How long the first request of a batch waits for company before running
+        executor: concurrent.futures executor that runs process_batch (the loop's default if None);
+            batchers sharing one executor share its workers
+        max_pending: Requests allowed to wait for a batch; further submits raise QueueFull
+        history: Number of recent batches kept for the size/latency metrics
+    """
+
+    def __init__(self, process_batch, max_batch_size=16, max_wait_ms=5.0, executor=None, max_pending=None, history=1024):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._arrived = None
+        self._worker = None
+
+        self.total_batches = 0
+        self.total_requests = 0
+        self.rejected = 0
+        self.batch_sizes = deque(maxlen=history)
+        self.batch_latencies = deque(maxlen=history)  # seconds spent in process_batch
+        self.queue_waits = deque(maxlen=history)  # seconds the oldest request of a batch waited
+
+    async def submit(self, item):
+        """Queue one request and wait for its share of the batched result."""
+        self._admit(1)
+        return await self._enqueue(item)
+
+    async def submit_many(self, items):
+        """Queue several requests and wait for all their results, in order.
+
+        Items are admitted at most max_pending at a time, each chunk all or none, so one large
+        request fits an idle batcher and is never left half queued when the batcher is busy.
+        """
+        step = self.max_pending or len(items) or 1
+        results = []
+        for start in range(0, len(items), step):
+            chunk = items[start:start + step]
+            self._admit(len(chunk))
+            results += await asyncio.gather(*(self._enqueue(item) for item in chunk))
+        return results
+
+    def _admit(self, count):
+        if self.max_pending is not None and len(self._pending) + count > self.max_pending:
+            self.rejected += count
+            raise QueueFull(f"{len(self._pending)} requests already waiting")
+
+    def _enqueue(self, item):
+        if self._worker is None or self._worker.done():
+            self._arrived = asyncio.Event()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future, time.perf_counter()))
+        self._arrived.set()
+        return future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._arrived.clear()
+                await self._arrived.wait()
+
+            # Wait until the batch is full or the oldest request has waited max_wait
+            deadline = self._pending[0][2] + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.max_batch_size))]
+            items = [item for item, _, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, items)
+            except Exception as exc:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            finally:
+                self._record(len(batch), start - batch[0][2], time.perf_counter() - start)
+
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _record(self, size, wait, latency):
+        self.total_batches += 1
+        self.total_requests += size
+        self.batch_sizes.append(size)
+        self.queue_waits.append(wait)
+        self.batch_latencies.append(latency)
+
+    def stats(self):
+        """Summary of recent batches, used to tune max_wait_ms/max_batch_size against latency targets."""
+        sizes = list(self.batch_sizes)
+        latencies = [t * 1000 for t in self.batch_latencies]
+        waits = [t * 1000 for t in self.queue_waits]
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "total_batches": self.total_batches,
+            "total_requests": self.total_requests,
+            "pending": len(self._pending),
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "mean_batch_size": sum(sizes) / len(sizes) if sizes else 0.0,
+            "batch_size_hist": {size: sizes.count(size) for size in sorted(set(sizes))},
+            "batch_latency_ms": {
+                "p50": _percentile(latencies, 50),
+                "p90": _percentile(latencies, 90),
+                "p99": _percentile(latencies, 99),
+            },
+            "queue_wait_ms": {
+                "p50": _percentile(waits, 50),
+                "p90": _percentile(waits, 90),
+                "p99": _percentile(waits, 99),
+            },
+        }
@@ -0,0 +1,200 @@
+"""Inference benchmarks for the serving stack, written as JSON to compare between commits.
+
+    python benchmark.py --out bench.json                        # model sweeps + in-process load test
+    python benchmark.py --baseline bench_main.json --out bench.json   # exit 1 on latency regressions
+
+Two parts, both on the code paths main.py serves:
+  model: each endpoint's batch function (run_fill_mask, run_ner, ...) timed directly over a sweep of
+         batch sizes, sequence lengths and torch thread counts.
+  load:  the FastAPI app driven in-process through httpx with concurrent clients, so micro-batching,
+         request validation and response serialisation are included.
+
+Without models/snapshot.pt the models get seeded random weights (SABDA_RANDOM_WEIGHTS=1), which
+time the same as trained ones. The hidden-state cache is disabled unless SABDA_CACHE_MB is set, so
+repeated texts are encoded every time.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from quantize import CHECK_TEXTS
+
+if not os.path.exists("models/snapshot.pt"):
+    os.environ.setdefault("SABDA_RANDOM_WEIGHTS", "1")
+os.environ.setdefault("SABDA_CACHE_MB", "0")
+
+import httpx
+import torch
+
+import main
+
+ENDPOINTS = {
+    "fill-mask": main.run_fill_mask,
+    "ner": main.run_ner,
+    "pos": main.run_pos,
+    "analyze": main.run_analyze,
+}
+
+
+def percentiles(seconds):
+    p50, p90, p99 = np.percentile(np.asarray(seconds) * 1000, [50, 90, 99])
+    return {"p50_ms": round(float(p50), 3), "p90_ms": round(float(p90), 3), "p99_ms": round(float(p99), 3)}
+
+
+def make_text(num_tokens, mask=False):
+    """A sentence of roughly num_tokens tokens (CLS/SEP included), built from the quantize check texts."""
+    words = " ".join(CHECK_TEXTS).split()
+    text = []
+    while len(main.get_tokenizer().encode_ids([" ".join(text)])[0]) < num_tokens - 2:
+        text.append(words[len(text) % len(words)])
+    if mask:
+        text[len(text) // 2] = "<mask>"
+    return " ".join(text)
+
+
+def sweep_models(batch_sizes, seq_lens, threads, repeats, warmup):
+    results = []
+    for num_threads in threads:
+        torch.set_num_threads(num_threads)
+        for endpoint, run in ENDPOINTS.items():
+            for seq_len in seq_lens:
+                text = make_text(seq_len, mask=endpoint == "fill-mask")
+                for batch_size in batch_sizes:
+                    batch = [text] * batch_size
+                    for _ in range(warmup):
+                        run(batch)
+                    latencies = []
+                    for _ in range(repeats):
+                        main.hidden_cache.clear()
+                        start = time.perf_counter()
+                        run(batch)
+                        latencies.append(time.perf_counter() - start)
+                    mean = sum(latencies) / len(latencies)
+                    results.append({
+                        "endpoint": endpoint, "threads": num_threads, "batch_size": batch_size, "seq_len": seq_len,
+                        **percentiles(latencies),
+                        "texts_per_sec": round(batch_size / mean, 2),
+                        "tokens_per_sec": round(batch_size * seq_len / mean, 1),
+                    })
+                    print(json.dumps(results[-1]), file=sys.stderr)
+    return results
+
+
+async def load_test(concurrencies, num_requests, seq_len):
+    transport = httpx.ASGITransport(app=main.app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for endpoint in ENDPOINTS:
+            body = {"text": make_text(seq_len, mask=endpoint == "fill-mask")}
+            for concurrency in concurrencies:
+                latencies, errors = [], 0
+                queue = asyncio.Queue()
+                for _ in range(num_requests):
+                    queue.put_nowait(body)
+
+                async def client_loop():
+                    nonlocal errors
+                    while not queue.empty():
+                        payload = queue.get_nowait()
+                        start = time.perf_counter()
+                        response = await client.post(f"/{endpoint}", json=payload)
+                        latencies.append(time.perf_counter() - start)
+                        errors += response.status_code != 200
+
+                main.hidden_cache.clear()
+                batcher = main.batchers[endpoint]
+                batches_before, requests_before = batcher.total_batches, batcher.total_requests
+                start = time.perf_counter()
+                await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+                elapsed = time.perf_counter() - start
+                batches = batcher.total_batches - batches_before
+                results.append({
+                    "endpoint": endpoint, "concurrency": concurrency, "requests": num_requests, "seq_len": seq_len,
+                    "errors": errors, **percentiles(latencies),
+                    "requests_per_sec": round(num_requests / elapsed, 2),
+                    "mean_batch_size": round((batcher.total_requests - requests_before) / batches, 2) if batches else 0.0,
+                })
+                print(json.dumps(results[-1]), file=sys.stderr)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "device": str(main.device),
+        "cpu_count": os.cpu_count(),
+        "precision": main.PRECISION,
+        "random_weights": os.environ.get("SABDA_RANDOM_WEIGHTS") == "1",
+        "max_batch_size": main.MAX_BATCH_SIZE,
+        "max_wait_ms": main.MAX_WAIT_MS,
+        "inference_workers": main.INFERENCE_WORKERS,
+        "torch_threads": main.TORCH_THREADS,
+        "load_seconds": {name: round(seconds, 3) for name, seconds in main.registry.load_seconds.items()},
+    }
+
+
+def regressions(baseline, current, max_regression):
+    """Entries whose p50 latency got worse than the baseline by more than max_regression (a fraction)."""
+    found = []
+    for part, keys in (("model", ("endpoint", "threads", "batch_size", "seq_len")),
+                       ("load", ("endpoint", "concurrency", "seq_len"))):
+        previous = {tuple(entry[k] for k in keys): entry for entry in baseline.get(part, [])}
+        for entry in current.get(part, []):
+            before = previous.get(tuple(entry[k] for k in keys))
+            if before and entry["p50_ms"] > before["p50_ms"] * (1 + max_regression):
+                found.append({"part": part, **{k: entry[k] for k in keys},
+                              "baseline_p50_ms": before["p50_ms"], "p50_ms": entry["p50_ms"]})
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the serving models and the FastAPI app")
+    parser.add_argument("--batch_sizes", default=[1, 8, 32], type=int, nargs="+")
+    parser.add_argument("--seq_lens", default=[16, 64, 256], type=int, nargs="+")
+    parser.add_argument("--threads", default=[torch.get_num_threads()], type=int, nargs="+")
+    parser.add_argument("--repeats", default=10, type=int, help="Timed runs per model configuration")
+    parser.add_argument("--warmup", default=2, type=int, help="Untimed runs per model configuration")
+    parser.add_argument("--concurrency", default=[1, 8, 32], type=int, nargs="+", help="Concurrent clients in the load test")
+    parser.add_argument("--requests", default=200, type=int, help="Requests per endpoint and concurrency level")
+    parser.add_argument("--load_seq_len", default=32, type=int, help="Tokens per load test request")
+    parser.add_argument("--skip_model", action="store_true")
+    parser.add_argument("--skip_load", action="store_true")
+    parser.add_argument("--out", default=None, help="Write the results here (stdout otherwise)")
+    parser.add_argument("--baseline", default=None, help="Earlier results to check for latency regressions")
+    parser.add_argument("--max_regression", default=0.10, type=float, help="Allowed p50 slowdown against the baseline")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    main.preload("all")  # loading is timed on its own, and the precision actually used is known
+    results = {"environment": environment()}
+    if not args.skip_model:
+        results["model"] = sweep_models(args.batch_sizes, args.seq_lens, args.threads, args.repeats, args.warmup)
+    if not args.skip_load:
+        results["load"] = asyncio.run(load_test(args.concurrency, args.requests, args.load_seq_len))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(json.load(f), results, args.max_regression)
+        for entry in found:
+            print(f"Regression: {json.dumps(entry)}", file=sys.stderr)
+        if found:
+            sys.exit(1)
@@ -0,0 +1,270 @@
+"""Tag and embed large corpora offline, streaming from input files to JSONL or Parquet.
+
+    python bulk.py articles.jsonl --out tagged.jsonl --tasks ner pos embed
+    python bulk.py corpus.tsv --text_column 1 --id_column 0 --out tagged --format parquet
+
+Documents are read lazily and tokenized in a process pool. Each buffer of --buffer_docs documents is
+sorted by length and cut into batches of at most --max_tokens padded tokens, so a batch holds
+documents of similar length; documents past 512 tokens go through the same overlapping windows as
+the server (main.encode_long). Results come out in input order, one record per document:
+
+    {"id": "...", "ner": [{"text", "type", "start", "end"}, ...], "pos": [...], "embedding": [...]}
+
+Progress is saved after every buffer (<out>.progress.json); rerunning the same command resumes after
+the last complete buffer. The models are main.py's, configured by the same SABDA_* variables.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+import main
+from cache import normalize
+from decoding import original_offsets
+from model import pool_sentences
+from nepalitokenizer import NepaliTokenizer
+
+_tokenizer = None
+_max_length = None
+
+
+def _init_worker(tokenizer_path, max_length):
+    global _tokenizer, _max_length
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"  # one process per core already
+    _tokenizer = NepaliTokenizer(load_path=tokenizer_path)
+    _max_length = max_length
+
+
+def _encode_chunk(records):
+    """(seq, id, text) records -> (seq, id, text, input_ids, offsets, word_ids), unpadded int32 arrays."""
+    texts = [text for _, _, text in records]
+    encoded = _tokenizer.encode_batch([normalize(text) for text in texts], max_length=_max_length,
+                                      return_offsets=True, return_word_ids=True)
+    offsets = original_offsets(texts, encoded["offsets"])  # into the text as read
+    lengths = encoded["attention_mask"].sum(dim=1).tolist()
+    return [
+        (seq, doc_id, text,
+         encoded["input_ids"][row, :length].numpy().astype(np.int32),
+         offsets[row, :length].astype(np.int32),
+         encoded["word_ids"][row, :length].numpy().astype(np.int32))
+        for row, ((seq, doc_id, _), text, length) in enumerate(zip(records, texts, lengths))
+    ]
+
+
+def read_records(paths, text_field="text", id_field="id", text_column=None, id_column=None, skip_header=False):
+    """Yield (seq, id, text) for every non-empty document; seq counts every input record, empty or not.
+
+    .jsonl files are read as JSON objects, anything else as lines of tab-separated columns (the
+    whole line is the text if text_column is unset). Documents without an id get their seq.
+    """
+    seq = 0
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            if skip_header and not path.endswith(".jsonl"):
+                next(f, None)
+            for line in f:
+                line = line.rstrip("\n")
+                if path.endswith(".jsonl"):
+                    record = json.loads(line) if line.strip() else {}
+                    text, doc_id = record.get(text_field) or "", record.get(id_field)
+                else:
+                    fields = line.split("\t")
+                    text = line if text_column is None else (fields[text_column] if text_column < len(fields) else "")
+                    doc_id = fields[id_column] if id_column is not None and id_column < len(fields) else None
+                if text.strip():
+                    yield seq, str(seq if doc_id is None else doc_id), text
+                seq += 1
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def length_batches(docs, max_tokens, max_batch_size):
+    """Indices of docs in batches of similar length, each at most max_tokens once padded."""
+    order = sorted(range(len(docs)), key=lambda i: len(docs[i][3]))
+    batch = []
+    for i in order:
+        # Sorted ascending, so the document being added is the longest of the batch
+        if batch and (len(batch) == max_batch_size or (len(batch) + 1) * len(docs[i][3]) > max_tokens):
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def pad(arrays, width, value, dtype=torch.long):
+    padded = torch.full((len(arrays), width) + arrays[0].shape[1:], value, dtype=dtype)
+    for row, array in enumerate(arrays):
+        padded[row, :len(array)] = torch.from_numpy(array.astype(np.int64))
+    return padded
+
+
+def run_batch(docs, tasks, pooling, project):
+    """Results of one batch of encoded documents, in the order given."""
+    model = main.get_model()  # loads on the first batch and sets main.compute_dtype
+    lengths = [len(doc[3]) for doc in docs]
+    if max(lengths) > main.MAX_LENGTH:
+        width = max(lengths)
+    else:
+        width = main.padded_width(max(lengths))
+    input_ids = pad([doc[3] for doc in docs], width, main.get_tokenizer().pad_token_id)
+    attention_mask = (torch.arange(width) < torch.tensor(lengths)[:, None]).long()
+
+    short = [row for row, length in enumerate(lengths) if length <= main.MAX_LENGTH]
+    if len(short) == len(docs):
+        with torch.no_grad():
+            hidden = model(input_ids.to(main.device), attention_mask.to(main.device)).to(main.compute_dtype)
+    else:
+        # Documents past the position table are encoded one by one in overlapping windows,
+        # the rest of the batch in one forward pass as usual
+        long = [row for row, length in enumerate(lengths) if length > main.MAX_LENGTH]
+        states = [main.encode_long(input_ids[row, :lengths[row]]) for row in long]
+        hidden = torch.zeros((len(docs), width, states[0].size(-1)), dtype=main.compute_dtype, device=main.device)
+        for row, doc_states in zip(long, states):
+            hidden[row, :len(doc_states)] = doc_states.to(hidden.dtype)
+        if short:
+            short_width = main.padded_width(max(lengths[row] for row in short))
+            rows = torch.tensor(short)
+            with torch.no_grad():
+                hidden[rows, :short_width] = model(
+                    input_ids[rows, :short_width].to(main.device), attention_mask[rows, :short_width].to(main.device)
+                ).to(hidden.dtype)
+
+    texts = [doc[2] for doc in docs]
+    head_tasks = [task for task in tasks if task in main.task_decoders]
+    if head_tasks:
+        word_ids = pad([doc[5] for doc in docs], width, -1)
+        offsets = pad([doc[4] for doc in docs], width, 0)
+        results = main.decode_tasks(texts, hidden, word_ids, offsets, head_tasks)
+    else:
+        results = [{} for _ in docs]
+
+    if "embed" in tasks:
+        with torch.no_grad():
+            vectors = pool_sentences(hidden, attention_mask.to(main.device), pooling)
+            if project:
+                vectors = model.project(vectors)
+        for result, vector in zip(results, vectors.float().cpu().tolist()):
+            result["embedding"] = vector
+    return [{"id": doc[1], **result} for doc, result in zip(docs, results)]
+
+
+class JSONLWriter:
+    """Results appended to one file; resuming truncates it to the size of the last complete buffer."""
+
+    def __init__(self, path, progress):
+        self.path = path
+        mode = "r+b" if progress.get("size") is not None and os.path.exists(path) else "wb"
+        self._file = open(path, mode)
+        if mode == "r+b":
+            self._file.truncate(progress["size"])
+            self._file.seek(progress["size"])
+
+    def write(self, results):
+        self._file.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in results).encode("utf-8"))
+        self._file.flush()
+        return {"size": self._file.tell()}
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """One part-XXXXX.parquet file per buffer in the output directory (needs pyarrow)."""
+
+    def __init__(self, path, progress):
+        import pyarrow  # noqa: F401, fail before any work is done
+        self.path = path
+        self.parts = progress.get("parts", 0)
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):  # parts of a buffer that was not finished
+            if name.startswith("part-") and int(name[5:10]) >= self.parts:
+                os.remove(os.path.join(path, name))
+
+    def write(self, results):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.Table.from_pylist(results), os.path.join(self.path, f"part-{self.parts:05d}.parquet"))
+        self.parts += 1
+        return {"parts": self.parts}
+
+    def close(self):
+        pass
+
+
+def main_loop(args):
+    progress_path = args.out.rstrip("/") + ".progress.json"
+    progress = {"records": 0}
+    if os.path.exists(progress_path) and not args.restart:
+        with open(progress_path) as f:
+            progress = json.load(f)
+        print(f"Resuming after {progress['records']} records", file=sys.stderr)
+    writer = (ParquetWriter if args.format == "parquet" else JSONLWriter)(args.out, progress)
+
+    records = read_records(args.inputs, args.text_field, args.id_field, args.text_column, args.id_column, args.skip_header)
+    records = (record for record in records if record[0] >= progress["records"])
+    start = last_report = time.perf_counter()
+    num_docs = num_tokens = 0
+    with Pool(args.workers, initializer=_init_worker, initargs=(args.tokenizer, main.MAX_DOCUMENT_TOKENS)) as pool:
+        # imap keeps the input order and tokenizes ahead of the model
+        encoded = (doc for chunk in pool.imap(_encode_chunk, chunked(records, args.chunk_docs)) for doc in chunk)
+        for buffer in chunked(encoded, args.buffer_docs):
+            results = [None] * len(buffer)
+            for batch in length_batches(buffer, args.max_tokens, args.batch_size):
+                for i, result in zip(batch, run_batch([buffer[i] for i in batch], args.tasks, args.pooling, args.project)):
+                    results[i] = result
+            progress.update(writer.write(results), records=buffer[-1][0] + 1)
+            with open(progress_path + ".tmp", "w") as f:
+                json.dump(progress, f)
+            os.replace(progress_path + ".tmp", progress_path)
+
+            num_docs += len(buffer)
+            num_tokens += sum(len(doc[3]) for doc in buffer)
+            now = time.perf_counter()
+            if now - last_report >= args.report_every:
+                elapsed = now - start
+                print(f"{progress['records']} records | {num_docs} docs | {num_docs / elapsed:.1f} docs/s | "
+                      f"{num_tokens / elapsed:.0f} tokens/s", file=sys.stderr)
+                last_report = now
+    writer.close()
+    elapsed = time.perf_counter() - start
+    print(f"Processed {num_docs} docs / {num_tokens} tokens in {elapsed:.1f}s "
+          f"({num_docs / max(elapsed, 1e-9):.1f} docs/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a corpus through NER/POS tagging and sentence embeddings")
+    parser.add_argument("inputs", nargs="+", help=".jsonl files of objects, or text/TSV files with one document per line")
+    parser.add_argument("--out", required=True, help="Output .jsonl file, or directory of parquet parts")
+    parser.add_argument("--format", default="jsonl", choices=["jsonl", "parquet"])
+    parser.add_argument("--tasks", default=["ner", "pos"], nargs="+", choices=["ner", "pos", "embed"])
+    parser.add_argument("--pooling", default="mean", choices=["cls", "mean"], help="Sentence pooling for embed")
+    parser.add_argument("--project", action="store_true", help="Pass embeddings through cls_head")
+    parser.add_argument("--text_field", default="text", help="JSONL key holding the text")
+    parser.add_argument("--id_field", default="id", help="JSONL key holding the document id")
+    parser.add_argument("--text_column", default=None, type=int, help="TSV column holding the text (whole line if unset)")
+    parser.add_argument("--id_column", default=None, type=int, help="TSV column holding the document id")
+    parser.add_argument("--skip_header", action="store_true")
+    parser.add_argument("--tokenizer", default="nepali_tokenizer.json")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int, help="Tokenizer processes")
+    parser.add_argument("--chunk_docs", default=256, type=int, help="Documents sent to a worker at a time")
+    parser.add_argument("--buffer_docs", default=4096, type=int, help="Documents sorted into length buckets together")
+    parser.add_argument("--batch_size", default=64, type=int, help="Most documents per forward pass")
+    parser.add_argument("--max_tokens", default=16384, type=int, help="Most padded tokens per forward pass")
+    parser.add_argument("--report_every", default=30, type=float, help="Seconds between throughput lines")
+    parser.add_argument("--restart", action="store_true", help="Ignore saved progress and start over")
+    main_loop(parser.parse_args())
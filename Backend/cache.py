@@ -0,0 +1,197 @@
+import hashlib
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import torch
+
+
+def normalize(text):
+    return unicodedata.normalize("NFC", text)
+
+
+def text_key(text):
+    """Cache key for a text: hash of its NFC-normalised form."""
+    return hashlib.sha256(normalize(text).encode("utf-8")).hexdigest()
+
+
+class HiddenStateCache:
+    """LRU cache of encoder outputs with a memory budget and a time-to-live.
+
+    Each entry holds the token ids and the backbone hidden states of one text (unpadded), so
+    repeated texts skip the transformer; callers still tokenize every text and only reuse states
+    whose token ids match the fresh encoding. With ``disk_dir`` set, entries
+    are also written there and survive restarts. Disk entries live in a subdirectory named by
+    ``fingerprint``, so states encoded by another model or configuration are never read back;
+    the sweep that bounds the disk tier removes those old subdirectories' entries as they age.
+
+    Args:
+        max_bytes: Memory budget for the in-memory tier; least recently used entries are evicted beyond it
+        ttl: Seconds after which an entry is treated as missing
+        fp16: Store hidden states as float16 to fit twice as many entries
+        disk_dir: Optional directory for the on-disk tier
+        fingerprint: Identifies the model and settings the hidden states come from
+        max_disk_bytes: Budget for the whole disk tier; expired, then oldest entries are deleted beyond it
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, ttl=3600, fp16=False, disk_dir=None, fingerprint="default",
+                 max_disk_bytes=1024 * 2**20):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.fp16 = fp16
+        self.disk_dir = disk_dir
+        self.fingerprint = fingerprint
+        self.max_disk_bytes = max_disk_bytes
+
+        self._entries = OrderedDict()  # key -> (input_ids, hidden, expires_at, nbytes)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.disk_bytes = 0
+        self.disk_evictions = 0
+        self._disk_writes = 0
+        if disk_dir:
+            os.makedirs(os.path.join(disk_dir, fingerprint), exist_ok=True)
+            self.sweep_disk()
+
+    def get(self, key):
+        """Return (input_ids, hidden) for key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0], entry[1]
+                self._remove(key)
+                self.expirations += 1
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, *entry)
+            return entry
+
+    def put(self, key, input_ids, hidden):
+        input_ids = input_ids.detach().to("cpu", torch.int32)
+        hidden = hidden.detach().to("cpu", torch.float16 if self.fp16 else torch.float32)
+        with self._lock:
+            self._insert(key, input_ids, hidden)
+        self._write_disk(key, input_ids, hidden)
+
+    def _insert(self, key, input_ids, hidden):
+        nbytes = input_ids.nbytes + hidden.nbytes
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (input_ids, hidden, time.monotonic() + self.ttl, nbytes)
+        self.current_bytes += nbytes
+        while self.current_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        self.current_bytes -= self._entries.pop(key)[3]
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, self.fingerprint, key[:2], key + ".pt")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            entry = torch.load(path, map_location="cpu", weights_only=True)
+        except Exception:  # missing, expired by another worker or half-written: treat as a miss
+            return None
+        return entry["input_ids"], entry["hidden"]
+
+    def _write_disk(self, key, input_ids, hidden):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        torch.save({"input_ids": input_ids, "hidden": hidden}, tmp_path)
+        os.replace(tmp_path, path)  # readers never see a partial file
+
+        # Other processes write to the same directory, so the running total is only an estimate
+        # between sweeps; a sweep recounts every file
+        with self._lock:
+            self.disk_bytes += os.path.getsize(path)
+            self._disk_writes += 1
+            sweep = self.disk_bytes > self.max_disk_bytes or self._disk_writes % 1024 == 0
+        if sweep:
+            self.sweep_disk()
+
+    def sweep_disk(self):
+        """Delete expired disk entries, of any fingerprint, then the oldest until the tier fits max_disk_bytes."""
+        files = []
+        now = time.time()
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # removed by another worker meanwhile
+                    continue
+                if name.endswith(".tmp") and now - stat.st_mtime <= self.ttl:
+                    continue  # being written
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            # Oldest first, so the first entry that is fresh and fits the budget ends the sweep
+            if now - mtime <= self.ttl and total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            removed += 1
+        with self._lock:
+            self.disk_bytes = total
+            self.disk_evictions += removed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "fp16": self.fp16,
+                "disk_dir": self.disk_dir,
+                "fingerprint": self.fingerprint,
+                "disk_bytes": self.disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes,
+                "disk_evictions": self.disk_evictions,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
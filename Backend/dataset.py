@@ -1,10 +1,15 @@
+import json
+import os
+
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
 
-from datasets import load_dataset
 
 class NepaliDataset(Dataset):
     def __init__(self, tokenizer, max_length=128):
+        from datasets import load_dataset
+
         self.dataset = load_dataset("IRIISNEPAL/Nepali-Text-Corpus")
         self.texts = self.dataset['train']['Article']
         self.tokenizer = tokenizer
@@ -20,11 +25,105 @@ class NepaliDataset(Dataset):
             'input_ids': encoding[''],
             'attention_mask': encoding.attention_mask
         }
-    
+
+
+class PretokenizedDataset(Dataset):
+    """Memory-mapped token shards written by pretokenize.py.
+
+    Items are numpy views into the shards, so nothing is tokenized, copied or reopened per item.
+    CLS/SEP are not included; the collator adds them when it builds the batch.
+
+    Args:
+        data_dir: Directory holding index.json and the shards
+        max_length: Model sequence length; items hold at most max_length - 2 tokens to leave room for CLS/SEP
+        packed: If False every item is one document (truncated). If True items are consecutive
+            max_length - 2 token windows of the shard stream, with the document start offsets inside
+            each window so documents can be kept apart.
+    """
+
+    def __init__(self, data_dir, max_length=512, packed=False):
+        self.data_dir = data_dir
+        self.max_length = max_length
+        self.window = max_length - 2
+        self.packed = packed
+        with open(os.path.join(data_dir, "index.json")) as f:
+            self.index = json.load(f)
+        self.shards = self.index["shards"]
+
+        # Global item index -> (shard, local index) through cumulative item counts
+        counts = [
+            shard["num_tokens"] // self.window if packed else shard["num_docs"]
+            for shard in self.shards
+        ]
+        self.cumulative = np.cumsum([0] + counts)
+        self._tokens = None
+        self._offsets = None
+
+    def _open(self):
+        # Mapped once per process; DataLoader workers reuse the mapping for every item
+        self._tokens = [
+            np.memmap(os.path.join(self.data_dir, shard["tokens"]), dtype=np.uint16, mode="r")
+            for shard in self.shards
+        ]
+        self._offsets = [
+            np.load(os.path.join(self.data_dir, shard["offsets"]), mmap_mode="r")
+            for shard in self.shards
+        ]
+
+    def __getstate__(self):
+        # Workers started with spawn re-map the shards instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        state["_offsets"] = None
+        return state
+
+    def __len__(self):
+        return int(self.cumulative[-1])
+
+    def __getitem__(self, idx):
+        if self._tokens is None:
+            self._open()
+        if idx < 0:
+            idx += len(self)
+        shard = int(np.searchsorted(self.cumulative, idx, side="right")) - 1
+        local = idx - int(self.cumulative[shard])
+        tokens, offsets = self._tokens[shard], self._offsets[shard]
+
+        if not self.packed:
+            start, end = int(offsets[local]), int(offsets[local + 1])
+            return {"input_ids": tokens[start:min(end, start + self.window)]}
+
+        start = local * self.window
+        end = start + self.window
+        # Documents beginning strictly inside the window; one starting at `end` belongs to the next window
+        first = np.searchsorted(offsets, start, side="right")
+        last = np.searchsorted(offsets, end, side="left")
+        doc_starts = np.asarray(offsets[first:last]) - start
+        return {"input_ids": tokens[start:end], "doc_starts": doc_starts}
+
+    def lengths(self):
+        """Token count of every item, read from the offsets alone (for length statistics)."""
+        if not self.packed:
+            return np.concatenate([
+                np.minimum(np.diff(np.load(os.path.join(self.data_dir, shard["offsets"]), mmap_mode="r")), self.window)
+                for shard in self.shards
+            ])
+        return np.full(len(self), self.window)
+
+    def split(self, train_ratio=0.8, valid_ratio=0.1, seed=42):
+        indices = torch.randperm(len(self), generator=torch.Generator().manual_seed(seed)).tolist()
+        n_train = int(train_ratio * len(self))
+        n_valid = int(valid_ratio * len(self))
+        return (
+            Subset(self, indices[:n_train]),
+            Subset(self, indices[n_train:n_train + n_valid]),
+            Subset(self, indices[n_train + n_valid:]),
+        )
+
 
 if __name__=='__main__':
     from transformers import AutoTokenizer
 
     tokenizer = AutoTokenizer.from_pretrained("IRIISNEPAL/RoBERTa_Nepali_110M")
     dataset = NepaliDataset(tokenizer=tokenizer)
-    print(dataset[0])
\ No newline at end of file
+    print(dataset[0])
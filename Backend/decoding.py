@@ -0,0 +1,156 @@
+"""Turning head predictions into API results with array operations.
+
+Everything works on whole padded batches. The tokenizer's word_ids (batch, seq_len) say which
+whitespace word every token belongs to (-1 for special and padding tokens) and its offsets
+(batch, seq_len, 2) give each token's character span; the heads run on pooled word states, so
+predictions have shape (batch, num_words). Single predicted tokens (fill-mask) are looked up in a
+TokenTable built once from the vocabulary instead of being decoded one by one.
+"""
+import unicodedata
+
+import numpy as np
+
+
+class TokenTable:
+    """id -> token string and id -> is-continuation / is-special lookups built from the tokenizer vocab.
+
+    Strings are what tokenizer.decode gives for the id alone: special tokens decode to "".
+    """
+
+    def __init__(self, tokenizer, continuing_subword_prefix="##"):
+        vocab = tokenizer.tokenizer.get_vocab(with_added_tokens=True)
+        self.continuing_subword_prefix = continuing_subword_prefix
+        self.strings = [""] * (max(vocab.values()) + 1)
+        for token, idx in vocab.items():
+            self.strings[idx] = token
+        self.is_continuation = np.array([s.startswith(continuing_subword_prefix) for s in self.strings])
+        self.is_special = np.zeros(len(self.strings), dtype=bool)
+        for token in ("<pad>", "<unk>", "<cls>", "<sep>", "<mask>"):
+            idx = tokenizer.tokenizer.token_to_id(token)
+            if idx is not None:
+                self.is_special[idx] = True
+                self.strings[idx] = ""
+
+    def decode(self, token_ids):
+        """Strings of a sequence of single token ids."""
+        return [self.strings[idx] for idx in token_ids]
+
+
+class LabelTable:
+    """BIO labels as arrays: entity type code per label (0 for O) and whether the label begins a span."""
+
+    def __init__(self, idx2label):
+        self.types = [""]  # code 0 is O
+        size = max(idx2label) + 1
+        self.type_of = np.zeros(size, dtype=np.int64)
+        self.is_begin = np.zeros(size, dtype=bool)
+        for idx, label in idx2label.items():
+            if label == "O":
+                continue
+            prefix, _, entity = label.partition("-")
+            if entity not in self.types:
+                self.types.append(entity)
+            self.type_of[idx] = self.types.index(entity)
+            self.is_begin[idx] = prefix == "B"
+
+
+def word_spans(word_ids, offsets):
+    """Character span of every word from its tokens' offsets.
+
+    Returns starts and ends of shape (batch, num_words) and a mask of the words each row really has.
+    """
+    word_ids = np.asarray(word_ids)
+    offsets = np.asarray(offsets)
+    batch_size = len(word_ids)
+    num_words = int(word_ids.max()) + 1 if word_ids.size else 0
+    valid = word_ids >= 0
+    rows = np.nonzero(valid)[0]
+    slots = rows * num_words + word_ids[valid]
+
+    starts = np.full(batch_size * num_words, np.iinfo(np.int64).max)
+    ends = np.zeros(batch_size * num_words, dtype=np.int64)
+    np.minimum.at(starts, slots, offsets[..., 0][valid])
+    np.maximum.at(ends, slots, offsets[..., 1][valid])
+    mask = np.zeros(batch_size * num_words, dtype=bool)
+    mask[slots] = True
+    shape = (batch_size, num_words)
+    return starts.reshape(shape), ends.reshape(shape), mask.reshape(shape)
+
+
+def bio_spans(labels, predictions, mask, starts, ends):
+    """Group words into BIO entity spans for a whole batch.
+
+    A span starts at a B- word, or at an I- word that doesn't continue a span of the same type, and
+    extends over the following I- words of its type.
+
+    Returns one list per row of (start, end, type) character spans, type without the B-/I- prefix.
+    """
+    rows, _ = np.nonzero(mask)
+    predictions = np.asarray(predictions)[mask]
+    starts, ends = starts[mask], ends[mask]
+    types = labels.type_of[predictions]
+    begins = labels.is_begin[predictions]
+
+    previous_type = np.concatenate(([0], types[:-1]))
+    previous_row = np.concatenate(([-1], rows[:-1]))
+    entity = types > 0
+    opens = entity & (begins | (previous_type != types) | (previous_row != rows))
+
+    # Entity words are contiguous per span, so each span's end is the max over its run of words
+    entity_words = np.flatnonzero(entity)
+    span_bounds = np.flatnonzero(opens[entity_words])
+    span_words = entity_words[span_bounds]
+    span_ends = np.maximum.reduceat(ends[entity_words], span_bounds) if len(span_bounds) else ends[:0]
+
+    spans = [[] for _ in range(len(mask))]
+    for row, start, end, code in zip(rows[span_words].tolist(), starts[span_words].tolist(),
+                                     span_ends.tolist(), types[span_words].tolist()):
+        spans[row].append((start, end, labels.types[code]))
+    return spans
+
+
+def normalization_map(text):
+    """NFC-normalise text, keeping track of where every character came from.
+
+    Returns (normalized, starts, ends): starts[i] is the position in text of a span starting at
+    normalized[i], ends[i] that of a span ending there (both of length len(normalized) + 1). Text
+    is normalised in runs of a starter and its combining marks; characters of a run that changed
+    (e.g. U+0958 decomposed into two) all map to the whole run.
+    """
+    def nfc(part):
+        return unicodedata.normalize("NFC", part)
+
+    runs = []
+    for char in text:
+        if runs and unicodedata.combining(char):
+            runs[-1] += char
+        elif runs and nfc(runs[-1] + char) != nfc(runs[-1]) + nfc(char):
+            runs[-1] += char  # composes with the run before it, e.g. Hangul jamo
+        else:
+            runs.append(char)
+
+    pieces, starts, ends = [], [0], [0]
+    position = 0
+    for run in runs:
+        piece = nfc(run)
+        pieces.append(piece)
+        if piece == run:
+            starts.extend(range(position + 1, position + len(run) + 1))
+            ends.extend(range(position + 1, position + len(run) + 1))
+        else:
+            starts.extend([position] * (len(piece) - 1) + [position + len(run)])
+            ends.extend([position + len(run)] * len(piece))
+        position += len(run)
+    return "".join(pieces), np.array(starts), np.array(ends)
+
+
+def original_offsets(texts, offsets):
+    """Token offsets (batch, seq_len, 2) into the NFC forms of texts, mapped onto texts as given."""
+    offsets = np.asarray(offsets).copy()  # np.array on a torch tensor warns under numpy 2
+    for row, text in enumerate(texts):
+        if unicodedata.is_normalized("NFC", text):
+            continue
+        _, starts, ends = normalization_map(text)
+        offsets[row, :, 0] = starts[offsets[row, :, 0]]
+        offsets[row, :, 1] = ends[offsets[row, :, 1]]
+    return offsets
@@ -0,0 +1,105 @@
+"""Export the backbone and every task head as one self-contained TorchScript artifact.
+
+    python export.py --out models/sabdamanthan.torchscript.pt
+
+The artifact has dynamic batch and sequence axes and exposes the same calls main.py makes on the
+Python modules (forward, run_heads, lm_logits, project, mask_predictions), so the server can load it with
+SABDA_ARTIFACT=<path> instead of rebuilding NepaliTransformer/NERModel/POSModel and three state dicts.
+The encoder layers are compiled with their fused CPU/CUDA attention path.
+"""
+import argparse
+import json
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+
+from quantize import load_fp32
+
+
+class InferenceGraph(nn.Module):
+    """Backbone plus task heads with only the layers used at inference time."""
+
+    def __init__(self, multitask):
+        super().__init__()
+        self.backbone = multitask.embedding
+        # Dropout is a no-op in eval mode, so a head is just fc1 -> relu -> fc2
+        self.task_heads = nn.ModuleDict({
+            task: nn.Sequential(head.fc1, head.relu, head.fc2) for task, head in multitask.heads.items()
+        })
+
+    def forward(self, input_ids, attention_mask):
+        return self.backbone(input_ids, attention_mask)
+
+    @torch.jit.export
+    def run_heads(self, hidden, tasks: List[str]) -> Dict[str, torch.Tensor]:
+        outputs: Dict[str, torch.Tensor] = {}
+        for task, head in self.task_heads.items():
+            if task in tasks:
+                outputs[task] = head(hidden)
+        return outputs
+
+    @torch.jit.export
+    def lm_logits(self, hidden, positions):
+        return self.backbone.lm_logits(hidden, positions)
+
+    @torch.jit.export
+    def project(self, pooled):
+        return self.backbone.cls_head(pooled)
+
+    @torch.jit.export
+    def mask_predictions(
+        self, x, attention_mask, mask_token_id: int, k: int = 5
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        hidden = self.forward(x, attention_mask)
+        positions = (x == mask_token_id).nonzero()
+        log_probs = torch.log_softmax(self.backbone.lm_logits(hidden, positions).float(), dim=-1)
+        top_log_probs, top_ids = torch.topk(log_probs, k, dim=-1)
+        return positions, top_log_probs.exp(), top_ids
+
+
+def export(multitask, path):
+    graph = torch.jit.script(InferenceGraph(multitask).eval())
+    # Freezing inlines the weights as constants and lets the JIT fold the eval-only branches
+    graph = torch.jit.freeze(graph, preserved_attrs=["run_heads", "lm_logits", "project", "mask_predictions"])
+    config = {"tasks": list(multitask.heads.keys()), "d_model": multitask.embedding.embedding.embedding_dim}
+    torch.jit.save(graph, path, _extra_files={"config.json": json.dumps(config)})
+    return graph
+
+
+def verify(multitask, path, mask_token_id=4):
+    """Check the saved artifact against the Python modules at two different batch/sequence shapes."""
+    graph = torch.jit.load(path, map_location="cpu")
+    with torch.no_grad():
+        for batch_size, seq_len in ((1, 16), (3, 77)):
+            input_ids = torch.randint(5, 30000, (batch_size, seq_len))
+            input_ids[:, seq_len // 2] = mask_token_id
+            attention_mask = torch.ones_like(input_ids)
+            attention_mask[0, seq_len - 3:] = 0
+            real = attention_mask.bool()
+
+            expected = multitask(input_ids, attention_mask)
+            actual = graph.run_heads(graph(input_ids, attention_mask), list(expected.keys()))
+            for task in expected:
+                diff = (expected[task] - actual[task])[real].abs().max().item()
+                if diff > 1e-3:
+                    raise RuntimeError(f"{task} output differs by {diff} at shape {(batch_size, seq_len)}")
+
+            _, expected_probs, expected_ids = multitask.embedding.mask_predictions(input_ids, attention_mask, mask_token_id)
+            _, actual_probs, actual_ids = graph.mask_predictions(input_ids, attention_mask, mask_token_id)
+            if not torch.allclose(expected_probs, actual_probs, atol=1e-4):
+                raise RuntimeError(f"mask predictions differ at shape {(batch_size, seq_len)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export backbone + heads as one TorchScript artifact")
+    parser.add_argument("--models_dir", default="models", help="Directory with snapshot.pt, NER.pt and POS.pt")
+    parser.add_argument("--out", default="models/sabdamanthan.torchscript.pt")
+    parser.add_argument("--no_verify", action="store_true", help="Skip comparing the artifact with the Python modules")
+    args = parser.parse_args()
+
+    multitask = load_fp32(args.models_dir, "cpu")
+    export(multitask, args.out)
+    if not args.no_verify:
+        verify(multitask, args.out)
+    print(f"Inference graph saved at {args.out}")
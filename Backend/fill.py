@@ -64,16 +64,10 @@
 #     print(predict_masked_tokens())
 
 import argparse
-import pickle
-import token
-from pydoc import text
 
-import numpy as np
-import pandas as pd
-import tokenizers
 import torch
-import torch.nn as nn
 
+from decoding import TokenTable
 from model import NepaliTransformer
 from nepalitokenizer import NepaliTokenizer
 
@@ -97,64 +91,142 @@ def load_ids(model_path="snapshot.pt", tokenizer_path="nepali_tokenizer.json"):
 
 
 
-def get_predictions_for_masks(model, tokenizer, device, text, k=1):
+def substitute_masks(text, table, token_ids):
+    """Replace the <mask> markers of text, in reading order, with the strings of token_ids from a TokenTable.
+
+    A word-piece continuation (##...) is joined to the text before its mask, without the prefix.
+    """
+    for token_id in token_ids:
+        piece = table.strings[token_id]
+        start = text.find("<mask>")
+        if start == -1:
+            break
+        before, after = text[:start], text[start + len("<mask>"):]
+        if table.is_continuation[token_id]:
+            piece = piece[len(table.continuing_subword_prefix):]
+            before = before.rstrip()
+        text = before + piece + after
+    return text
+
+
+def fill_masks(model, tokenizer, device, text, strategy="parallel", beam_size=4, confidence=0.9, table=None):
+    """Fill every <mask> in text and return up to beam_size (filled_text, probability) pairs, best first.
+
+    strategy="parallel" fills all masks from a single forward pass.
+    strategy="iterative" fills the most confident mask first and feeds it back before predicting the rest,
+    keeping the beam_size best joint assignments. All beams are encoded together as one batch, and every
+    other mask whose top prediction is above ``confidence`` is filled in the same step, so the model is
+    only re-run while uncertain masks remain. ``table`` is the tokenizer's TokenTable, built here if not given.
+    """
+    table = table or TokenTable(tokenizer)
+    inputs = tokenizer.encode_batch([text])
+    input_ids = inputs["input_ids"].to(device)
+    attention_mask = inputs["attention_mask"].to(device)
+    mask_positions = (input_ids[0] == tokenizer.mask_token_id).nonzero().flatten()
+    if len(mask_positions) == 0:
+        return []
+
+    if strategy == "parallel":
+        with torch.no_grad():
+            _, probabilities, token_ids = model.mask_predictions(
+                input_ids, attention_mask, tokenizer.mask_token_id, k=1
+            )
+        filled = substitute_masks(text, table, token_ids[:, 0].tolist())
+        return [(filled, probabilities[:, 0].prod().item())]
+
+    if strategy != "iterative":
+        raise ValueError(f"Unknown fill strategy: {strategy}")
+
+    # Each beam is (input ids with some masks filled in, joint log probability)
+    beams = [(input_ids[0], 0.0)]
+    finished = []
+    while beams:
+        batch_ids = torch.stack([ids for ids, _ in beams])
+        with torch.no_grad():
+            positions, probabilities, token_ids = model.mask_predictions(
+                batch_ids, attention_mask.expand(len(beams), -1), tokenizer.mask_token_id, k=beam_size
+            )
+        log_probs = probabilities.log()
+
+        candidates = []
+        for row, (ids, score) in enumerate(beams):
+            rows = (positions[:, 0] == row).nonzero().flatten()
+            # Expand the most confident mask of this beam over its top tokens
+            best = rows[probabilities[rows, 0].argmax()]
+            # Masks the model is already sure about are filled greedily without another pass
+            sure = [m for m in rows.tolist() if m != best and probabilities[m, 0] >= confidence]
+            base = ids.clone()
+            base_score = score
+            for m in sure:
+                base[positions[m, 1]] = token_ids[m, 0]
+                base_score += log_probs[m, 0].item()
+            for j in range(token_ids.size(1)):
+                new_ids = base.clone()
+                new_ids[positions[best, 1]] = token_ids[best, j]
+                candidates.append((new_ids, base_score + log_probs[best, j].item()))
+
+        # Keep the best distinct joint assignments
+        candidates.sort(key=lambda c: c[1], reverse=True)
+        kept, seen = [], set()
+        for ids, score in candidates:
+            key = tuple(ids[mask_positions].tolist())
+            if key not in seen:
+                seen.add(key)
+                kept.append((ids, score))
+            if len(kept) == beam_size:
+                break
+        beams = [(ids, score) for ids, score in kept if (ids == tokenizer.mask_token_id).any()]
+        finished += [(ids, score) for ids, score in kept if not (ids == tokenizer.mask_token_id).any()]
+
+        # Stop once no open beam can beat the worst kept finished assignment
+        finished = sorted(finished, key=lambda c: c[1], reverse=True)[:beam_size]
+        if len(finished) == beam_size:
+            beams = [(ids, score) for ids, score in beams if score > finished[-1][1]]
+
+    return [
+        (substitute_masks(text, table, ids[mask_positions].tolist()), torch.tensor(score).exp().item())
+        for ids, score in finished
+    ]
+
+
+def get_predictions_for_masks(model, tokenizer, device, text, k=1, strategy="parallel", beam_size=4):
     # Tokenize the text and find all mask positions
-    inputs = tokenizer.encode(text)
+    inputs = tokenizer.encode_batch([text])
     mask_positions = [
-        i for i, e in enumerate(inputs["input_ids"]) if e == tokenizer.mask_token_id
+        i for i, e in enumerate(inputs["input_ids"][0]) if e == tokenizer.mask_token_id
     ]
 
     # If there's only one mask, output just the predicted tokens with probabilities
     if len(mask_positions) == 1:
-        mask_idx = mask_positions[0]
         predictions = []
 
+        # Top k predictions for the masked position, normalised over the full vocabulary
         with torch.no_grad():
-            lm_head, cls_embedding = model(
-                inputs["input_ids"].unsqueeze(0).to(device),
-                attention_mask=inputs["attention_mask"].unsqueeze(0).to(device),
+            _, probabilities, top_k_indices = model.mask_predictions(
+                inputs["input_ids"].to(device),
+                inputs["attention_mask"].to(device),
+                tokenizer.mask_token_id,
+                k=k,
             )
 
-        # Get probabilities for masked position
-        mask_logits = lm_head[0, mask_idx, :]
-
-        # Get top k predictions
-        top_k_logits, top_k_indices = torch.topk(mask_logits, k)
-
-        # Convert to probabilities using softmax
-        probabilities = torch.nn.functional.softmax(top_k_logits, dim=0)
-
-        # Convert to numpy for easier handling
-        top_k_indices = top_k_indices.cpu().numpy()
-        probabilities = probabilities.cpu().numpy()
+        top_k_indices = top_k_indices[0].tolist()
+        probabilities = probabilities[0].tolist()
 
         # Generate list of predicted tokens and their probabilities
-        for idx, prob in zip(top_k_indices, probabilities):
-            predicted_word = tokenizer.decode([int(idx)])
+        for predicted_word, prob in zip(TokenTable(tokenizer).decode(top_k_indices), probabilities):
             predictions.append(f"Token: {predicted_word} (probability: {prob:.4f})")
 
         return predictions
     else:
-        # Keep existing multiple mask handling
-        modified_text = text
-        for mask_idx in mask_positions:
-            with torch.no_grad():
-                lm_head, cls_embedding = model(
-                    inputs["input_ids"].unsqueeze(0).to(device),
-                    attention_mask=inputs["attention_mask"].unsqueeze(0).to(device),
-                )
-
-            mask_logits = lm_head[0, mask_idx, :]
-            top_k_logits, top_k_indices = torch.topk(mask_logits, 1)
-            probabilities = torch.nn.functional.softmax(top_k_logits, dim=0)
-            predicted_idx = top_k_indices[0]
-            predicted_word = tokenizer.decode([int(predicted_idx)])
-            modified_text = modified_text.replace("<mask>", predicted_word, 1)
-
-        return modified_text
+        # Multiple masks: return the best joint filling of the sentence, no mask: the text unchanged
+        filled = fill_masks(model, tokenizer, device, text, strategy=strategy, beam_size=beam_size)
+        return filled[0][0] if filled else text
 
 if __name__ == "__main__":
-
+    parser = argparse.ArgumentParser(description="Fill the <mask> tokens of a sentence")
+    parser.add_argument("--strategy", default="parallel", choices=["parallel", "iterative"], help="For several masks")
+    parser.add_argument("--beam_size", default=4, type=int, help="Beams kept by the iterative strategy")
+    args = parser.parse_args()
 
     # Extract the text entered by the user
     text = "नयाँ सरकार गठनपछि मुलुकमा <mask> स्थायित्व हुने भएकाले आर्थिक विकासले प्राथमिकता पाउने, राजस्व संकलन र पुँजीगत खर्च बढ्ने दाबी सरकारले गरे पनि नतिजा सन्तोषजनक छैन ।"
@@ -167,7 +239,9 @@ if __name__ == "__main__":
     print("Model Loaded")
 
     # Get the result based on the number of masks in the sentence
-    predictions = get_predictions_for_masks(model, tokenizer, device, text, k=5)
+    predictions = get_predictions_for_masks(
+        model, tokenizer, device, text, k=5, strategy=args.strategy, beam_size=args.beam_size
+    )
 
     if isinstance(predictions, list):
         print("\nGenerated sentences with top predictions for the mask:")
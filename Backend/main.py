@@ -1,17 +1,42 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
+from pydantic import BaseModel, Field
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import numpy as np
 import torch
-from model import NepaliTransformer, NERModel, POSModel
+from batcher import MicroBatcher, QueueFull
+from cache import HiddenStateCache, normalize, text_key
+from decoding import LabelTable, TokenTable, bio_spans, original_offsets, word_spans
+from fill import fill_masks, substitute_masks
+from model import NepaliTransformer, NERModel, POSModel, MultiTaskModel, pool_sentences, pool_words
 from nepalitokenizer import NepaliTokenizer
+from quantize import apply_precision, load_quantized
+from registry import ModelRegistry
+from vectorindex import IVFIndex
+from windows import make_windows, stitch, window_plan
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Preloading and warmup run on the inference pool while the server is already up; /ready
+    # answers 503 until they are done
+    app.state.startup = asyncio.get_running_loop().run_in_executor(inference_executor, prepare)
+    yield
 
-def devices ():
-    torch.manual_seed(42)
-    torch.cuda.manual_seed(42)
 
 # Initialize the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:5173",  # Or the origin of your React app
@@ -37,25 +62,56 @@ class TextRequest(BaseModel):
 class EntityResponse(BaseModel):
     text: str
     type: str
+    start: Optional[int] = None  # character offsets of text in the input, when the decoder knows them
+    end: Optional[int] = None
 
 
 class MaskRequest(BaseModel):
     text: str
+    strategy: str = "parallel"  # "parallel" or "iterative" when the text has several masks
+    beam_size: int = Field(default=4, ge=1, le=16)
 
 
-# Load the Nepali tokenizer
-tokenizer = NepaliTokenizer(load_path='nepali_tokenizer.json')
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+class AnalyzeResponse(BaseModel):
+    ner: List[EntityResponse]
+    pos: List[EntityResponse]
+
+
+class StreamRequest(BaseModel):
+    text: str
+    tasks: List[str] = ["ner", "pos"]
+
+
+class EmbedRequest(BaseModel):
+    texts: List[str] = Field(min_length=1, max_length=256)
+    pooling: str = "cls"  # "cls" or "mean" over the tokens
+    project: bool = False  # pass the pooled vector through the backbone's cls_head
+    normalize: bool = False  # scale to unit length
+
+
+class Document(BaseModel):
+    id: str
+    text: str
 
 
-# Load your trained model
-model = NepaliTransformer(vocab_size=30000, d_model=768, num_layers=6, num_heads=8).to(device)
-snapshot = torch.load(r'models/snapshot.pt', map_location=device)
-model.load_state_dict(snapshot['MODEL_STATE'])
-model.eval()
+class IngestRequest(BaseModel):
+    documents: List[Document] = Field(min_length=1, max_length=1024)
+
+
+class SearchRequest(BaseModel):
+    text: str
+    k: int = Field(default=10, ge=1, le=100)
+    nprobe: Optional[int] = Field(default=None, ge=1)
+
+
+class SearchResult(BaseModel):
+    id: str
+    text: str
+    score: float
+
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-nermodel = NERModel(model, hidden_dim=512, num_classes=7).to(device)
-nermodel.load_state_dict(torch.load(r"models/NER.pt", map_location=device))
 ner_idx2label = {
     0: 'O',
     1: 'B-LOC',
@@ -66,8 +122,6 @@ ner_idx2label = {
     6: 'I-PER'
 }
 
-posmodel = POSModel(model, hidden_dim=512, num_classes=39).to(device)
-posmodel.load_state_dict(torch.load(r"models/POS.pt", map_location=device))
 pos_idx2label = {
     0: 'CD',
     1: 'JJ',
@@ -110,118 +164,671 @@ pos_idx2label = {
     38: 'ALPH'
 }
 
+# BIO label lookups for decoding whole batches of entity spans
+ner_labels = LabelTable(ner_idx2label)
 
-@app.post("/fill-mask", response_model=List[tuple])
-def predict_masked_tokens(request: MaskRequest):
-    devices()
-    text = request.text
- 
-    if not text:
-        raise HTTPException(status_code=400, detail="Empty text received")
-    inputs = tokenizer.encode(text)
-    input_ids = inputs["input_ids"]
-    attention_mask = inputs["attention_mask"]
-    mask_positions = [i for i, e in enumerate(input_ids) if e == tokenizer.mask_token_id]
 
-    if not mask_positions:
-        raise HTTPException(status_code=400, detail="No mask token found in the input text")
+# Nothing is loaded at import: the tokenizer, the backbone and each task head load on first use,
+# or at startup for the names in SABDA_PRELOAD ("all" for everything)
+registry = ModelRegistry()
+
+# TorchScript graph written by export.py; when set, the backbone and heads are not rebuilt in Python
+ARTIFACT = os.environ.get("SABDA_ARTIFACT")
+# Single weights file written by serve.py; when set, it is used instead of the separate checkpoints
+SHARED_WEIGHTS = os.environ.get("SABDA_SHARED_WEIGHTS")
+
+# Inference precision: "fp32", "int8" (dynamic quantization, CPU only) or "bf16" (where natively supported)
+PRECISION = "fp32" if ARTIFACT else os.environ.get("SABDA_PRECISION", "fp32")
+INT8_CHECKPOINT = r'models/snapshot.int8.pt'  # written by quantize.py
+use_int8_checkpoint = PRECISION == "int8" and device.type == "cpu" and os.path.exists(INT8_CHECKPOINT) and not SHARED_WEIGHTS
+# Benchmarks only: skip every checkpoint and serve seeded random weights of the same shapes
+RANDOM_WEIGHTS = os.environ.get("SABDA_RANDOM_WEIGHTS", "0") == "1"
+if RANDOM_WEIGHTS:
+    use_int8_checkpoint = False
+# Inference-only weights written by the Trainer (--inference_path) skip the optimizer state
+WEIGHTS = r'models/snapshot.weights.pt'
+
+compute_dtype = torch.float32  # set by load_multitask to match the precision actually used
+
+task_models = {
+    "ner": lambda backbone: NERModel(backbone, hidden_dim=512, num_classes=len(ner_idx2label)),
+    "pos": lambda backbone: POSModel(backbone, hidden_dim=512, num_classes=len(pos_idx2label)),
+}
+
+
+TOKENIZER = 'nepali_tokenizer.json'
+
 
-    with torch.no_grad(): 
-        logits = model.lm_token(input_ids.unsqueeze(0).to(device), attention_mask=attention_mask.unsqueeze(0).to(device))
-        
+def load_tokenizer():
+    return NepaliTokenizer(load_path=TOKENIZER)
 
-        if len(mask_positions) == 1:
-            mask_idx = mask_positions[0]
-            mask_logits = logits[0, mask_idx, :]    
-            top_k_logits, top_k_indices = torch.topk(mask_logits, 5)  # Get top 5 predictions
-            probabilities = torch.nn.functional.softmax(top_k_logits, dim=-1)
-            predictions = [
-                (tokenizer.decode([int(idx)]), prob)
-                for idx, prob in zip(top_k_indices.tolist(), probabilities.tolist())
-            ]
 
+def checkpoint_state(part):
+    """State dict of the backbone ("backbone") or of a task model ("ner", "pos").
+
+    Every file is opened with mmap, and the modules are assigned its tensors rather than copying them,
+    so loading costs about the same however large the checkpoint is.
+    """
+    if SHARED_WEIGHTS:
+        prefix = "embedding." if part == "backbone" else f"heads.{part}."
+        state = registry.get("shared_weights")
+        return {name[len(prefix):]: tensor for name, tensor in state.items() if name.startswith(prefix)}
+    if part == "backbone":
+        if os.path.exists(WEIGHTS):
+            return torch.load(WEIGHTS, map_location=device, weights_only=True, mmap=True)['MODEL_STATE']
+        return torch.load(r'models/snapshot.pt', map_location=device, mmap=True)['MODEL_STATE']
+    return torch.load(rf"models/{part.upper()}.pt", map_location=device, mmap=True)
+
+
+def load_multitask():
+    """The backbone wrapped in a MultiTaskModel; task heads are added to it as they load."""
+    global PRECISION, compute_dtype
+    if ARTIFACT:
+        return torch.jit.load(ARTIFACT, map_location=device)  # heads included
+
+    if RANDOM_WEIGHTS:
+        torch.manual_seed(0)
+    model = NepaliTransformer(vocab_size=30000, d_model=768, num_layers=6, num_heads=8).to(device)
+    if use_int8_checkpoint:
+        # The int8 checkpoint holds the backbone and both heads, so they load together
+        heads = {task: build(model) for task, build in task_models.items()}
+        multitask = load_quantized(MultiTaskModel(model, heads).to(device), INT8_CHECKPOINT)
+    else:
+        if not RANDOM_WEIGHTS:
+            model.load_state_dict(checkpoint_state("backbone"), assign=True)
+        multitask = MultiTaskModel(model, {})
+        # bf16/int8 make private converted copies, so with SHARED_WEIGHTS only fp32 keeps the weights shared
+        PRECISION = apply_precision(model, PRECISION, device)
+    compute_dtype = torch.bfloat16 if PRECISION == "bf16" else torch.float32
+    return multitask.eval()
+
+
+def load_task(task):
+    """Add one task head to the shared MultiTaskModel."""
+    multitask = registry.get("multitask")
+    if ARTIFACT or use_int8_checkpoint:
+        return multitask  # loaded with the backbone
+
+    if RANDOM_WEIGHTS:
+        torch.manual_seed(0)
+    head = task_models[task](multitask.embedding).to(device)
+    if not RANDOM_WEIGHTS:
+        # Task checkpoints also carry a copy of the frozen backbone; only the head's own layers are loaded
+        state = checkpoint_state(task)
+        for name, layer in head.named_children():
+            if name != "embedding":
+                prefix = name + "."
+                layer.load_state_dict({key[len(prefix):]: value for key, value in state.items() if key.startswith(prefix)}, assign=True)
+    apply_precision(head, PRECISION, device)  # the backbone's layers are converted already and left as they are
+    multitask.heads[task] = head.eval()  # dropout off, so a request's output doesn't depend on what it is batched with
+    return head
+
+
+registry.register("tokenizer", load_tokenizer)
+# Token strings and ## continuations of the vocabulary, for fill-mask results without per-token decode calls
+registry.register("token_table", lambda: TokenTable(get_tokenizer()))
+registry.register("multitask", load_multitask)
+if SHARED_WEIGHTS:
+    registry.register("shared_weights", lambda: torch.load(SHARED_WEIGHTS, map_location=device, weights_only=True, mmap=True))
+for task in task_models:
+    registry.register(task, lambda task=task: load_task(task))
+
+
+def get_tokenizer():
+    return registry.get("tokenizer")
+
+
+def get_token_table():
+    return registry.get("token_table")
+
+
+def get_model():
+    """The backbone (the whole TorchScript graph when serving an artifact)."""
+    multitask = registry.get("multitask")
+    return multitask if ARTIFACT else multitask.embedding
+
+
+def get_multitask(tasks):
+    """The MultiTaskModel with at least the heads of tasks loaded."""
+    for task in tasks:
+        registry.get(task)
+    return registry.get("multitask")
+
+
+# Batches are padded to their longest sequence, rounded up to this multiple
+PAD_TO_MULTIPLE_OF = int(os.environ.get("SABDA_PAD_TO_MULTIPLE_OF", 8))
+
+# How the heads see a word split into several subwords: "first" subword or "mean" of all of them
+WORD_POOLING = os.environ.get("SABDA_WORD_POOLING", "first")
+
+# Positions in the backbone's table; longer documents run as overlapping windows of this many tokens
+MAX_LENGTH = 512
+WINDOW_OVERLAP = int(os.environ.get("SABDA_WINDOW_OVERLAP", 128))
+# Documents are still truncated here, so one request can't run an unbounded number of windows
+MAX_DOCUMENT_TOKENS = int(os.environ.get("SABDA_MAX_DOCUMENT_TOKENS", 16384))
+
+
+def padded_width(length):
+    """length rounded up to PAD_TO_MULTIPLE_OF (left as is when that is 0) and capped at MAX_LENGTH."""
+    if PAD_TO_MULTIPLE_OF:
+        length = -(-length // PAD_TO_MULTIPLE_OF) * PAD_TO_MULTIPLE_OF
+    return min(length, MAX_LENGTH)
+
+
+def cache_fingerprint():
+    """Hash of the weights, tokenizer and settings hidden states depend on, so a disk cache outlives a deploy safely."""
+    if ARTIFACT or SHARED_WEIGHTS:
+        weights = ARTIFACT or SHARED_WEIGHTS
+    elif RANDOM_WEIGHTS:
+        weights = None
+    elif use_int8_checkpoint:
+        weights = INT8_CHECKPOINT
+    else:
+        weights = WEIGHTS if os.path.exists(WEIGHTS) else r'models/snapshot.pt'
+    tokenizer_digest = None
+    if os.path.exists(TOKENIZER):
+        with open(TOKENIZER, "rb") as f:
+            tokenizer_digest = hashlib.sha256(f.read()).hexdigest()
+    config = {
+        "weights": weights and os.path.abspath(weights),
+        "mtime": os.path.getmtime(weights) if weights and os.path.exists(weights) else None,
+        "precision": PRECISION,
+        "artifact": ARTIFACT,
+        "tokenizer": tokenizer_digest,
+        "max_length": MAX_LENGTH,
+        "window_overlap": WINDOW_OVERLAP,
+        "max_document_tokens": MAX_DOCUMENT_TOKENS,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+# Encoder outputs of recently seen texts, shared by every task head
+hidden_cache = HiddenStateCache(
+    max_bytes=int(float(os.environ.get("SABDA_CACHE_MB", 256)) * 2**20),
+    ttl=float(os.environ.get("SABDA_CACHE_TTL", 3600)),
+    fp16=os.environ.get("SABDA_CACHE_FP16", "0") == "1",
+    disk_dir=os.environ.get("SABDA_CACHE_DIR") or None,
+    fingerprint=cache_fingerprint(),
+    max_disk_bytes=int(float(os.environ.get("SABDA_CACHE_DISK_MB", 1024)) * 2**20),
+)
+
+
+def run_fill_mask(texts):
+    """Fill the <mask> tokens of a batch of texts with one padded forward pass."""
+    tokenizer, model, table = get_tokenizer(), get_model(), get_token_table()
+    encoded = tokenizer.encode_batch(texts, pad_to_multiple_of=PAD_TO_MULTIPLE_OF)
+    input_ids = encoded["input_ids"]
+    attention_mask = encoded["attention_mask"]
+
+    with torch.no_grad():
+        # Only the <mask> rows go through the 30000-way lm_head
+        positions, probabilities, token_ids = model.mask_predictions(
+            input_ids.to(device), attention_mask.to(device), tokenizer.mask_token_id, k=5
+        )
+    positions, probabilities, token_ids = positions.tolist(), probabilities.tolist(), token_ids.tolist()
+
+    results = []
+    for row, text in enumerate(texts):
+        masks = [i for i, (mask_row, _) in enumerate(positions) if mask_row == row]
+        if not masks:
+            results.append(None)
+
+        elif len(masks) == 1:
+            results.append(list(zip(table.decode(token_ids[masks[0]]), probabilities[masks[0]])))
+
+        else:
+            # Parallel strategy: every mask takes its top prediction from this one pass
+            modified_text = substitute_masks(text, table, [token_ids[mask][0] for mask in masks])
+            joint_probability = 1.0
+            for mask in masks:
+                joint_probability *= probabilities[mask][0]
+
+            results.append([(modified_text, joint_probability)])
+    return results
+
+
+def run_fill_mask_iterative(requests):
+    """Most-confident-first beam search; each request batches its own beams."""
+    tokenizer, model = get_tokenizer(), get_model()
+    results = []
+    for text, beam_size in requests:
+        if tokenizer.mask_token_id not in tokenizer.encode_batch([text])["input_ids"][0]:
+            results.append(None)
         else:
-            modified_text = text
-            for mask_idx in sorted(mask_positions, reverse=True):
-                mask_logits = logits[0, mask_idx, :]
-                top_idx = torch.argmax(mask_logits).item()
-                predicted_word = tokenizer.decode([top_idx])
-                start_index = modified_text.find('<mask>')
-                if start_index != -1:
-                    end_index = start_index + len('<mask>')
-                    modified_text = modified_text[:start_index] + predicted_word + modified_text[end_index:]
-
-            predictions = [modified_text]
+            results.append(fill_masks(model, tokenizer, device, text, strategy="iterative", beam_size=beam_size,
+                                      table=get_token_table()))
+    return results
+
+
+def ner_entities(texts, words, predictions):
+    """BIO entity spans of every row, with character offsets into the text."""
+    starts, ends, mask = words
+    spans = bio_spans(ner_labels, predictions, mask, starts, ends)
+    return [
+        [{"text": text[start:end], "type": entity_type, "start": start, "end": end} for start, end, entity_type in row]
+        for text, row in zip(texts, spans)
+    ]
+
+
+def pos_tags(texts, words, predictions):
+    """One tag per whitespace word of every row, with its character offsets."""
+    starts, ends, mask = (array.tolist() for array in words)
+    return [
+        [
+            {"text": text[start:end], "type": pos_idx2label[tag], "start": start, "end": end}
+            for start, end, real, tag in zip(row_starts, row_ends, row_mask, row_tags) if real
+        ]
+        for text, row_starts, row_ends, row_mask, row_tags in zip(texts, starts, ends, mask, predictions.tolist())
+    ]
+
+
+# Decoders turning a batch of head predictions into one API response per text, keyed by task name
+task_decoders = {
+    "ner": ner_entities,
+    "pos": pos_tags,
+}
+
+
+def encode_long(input_ids):
+    """Hidden states of a document longer than MAX_LENGTH, from overlapping windows run as one batch."""
+    tokenizer, model = get_tokenizer(), get_model()
+    plan = window_plan(len(input_ids) - 2, MAX_LENGTH, WINDOW_OVERLAP)
+    windows = make_windows(input_ids, plan, tokenizer.cls_token_id, tokenizer.sep_token_id, MAX_LENGTH).to(device)
+    with torch.no_grad():
+        hidden = model(windows, torch.ones_like(windows))
+    return stitch(hidden, plan)
+
+
+def encode_hidden(texts, cache=True):
+    """Backbone hidden states for a batch of texts, reusing cached encodings of texts seen before.
+
+    The model sees the NFC form of every text. Returns the texts, their encoding (padded input_ids,
+    attention_mask, word ids and character offsets into the texts as given) and the hidden states
+    for the whole batch. Texts longer than MAX_LENGTH
+    tokens are encoded in overlapping windows (see windows.py) rather than truncated. With
+    cache=False the cache is neither read nor filled, e.g. for documents that are only seen once.
+    """
+    tokenizer, model = get_tokenizer(), get_model()  # the model first, it sets compute_dtype
+    normalized = [normalize(text) for text in texts]
+    # Tokenizing is cheap next to the encoder, so every text is tokenized; only cache misses are encoded
+    encoded = tokenizer.encode_batch(
+        normalized, max_length=MAX_DOCUMENT_TOKENS, pad_to_multiple_of=PAD_TO_MULTIPLE_OF,
+        return_offsets=True, return_word_ids=True,
+    )
+    encoded["offsets"] = torch.from_numpy(original_offsets(texts, encoded["offsets"]))
+    lengths = encoded["attention_mask"].sum(dim=1).tolist()
+    keys = [text_key(text) for text in normalized]
+    entries = [hidden_cache.get(key) if cache else None for key in keys]
+    for i, entry in enumerate(entries):
+        # States are only reused for the very tokens they were computed from
+        if entry is not None and not torch.equal(entry[0], encoded["input_ids"][i, :lengths[i]].to(entry[0].dtype)):
+            entries[i] = None
+
+    missing = [i for i, entry in enumerate(entries) if entry is None and lengths[i] <= MAX_LENGTH]
+    if missing:
+        width = padded_width(max(lengths[i] for i in missing))
+        rows = torch.tensor(missing)
+        with torch.no_grad():
+            hidden = model(
+                encoded["input_ids"][rows, :width].to(device), encoded["attention_mask"][rows, :width].to(device)
+            )
+        for row, i in enumerate(missing):
+            entries[i] = (encoded["input_ids"][i, :lengths[i]], hidden[row, :lengths[i]])
+            if cache:
+                hidden_cache.put(keys[i], *entries[i])
+
+    for i, entry in enumerate(entries):
+        if entry is None:
+            input_ids = encoded["input_ids"][i, :lengths[i]]
+            entries[i] = (input_ids, encode_long(input_ids))
+            if cache:
+                hidden_cache.put(keys[i], *entries[i])
+
+    # Cached and fresh rows padded into one batch for the heads
+    batch_size, padded_length = encoded["input_ids"].shape
+    hidden = torch.zeros((batch_size, padded_length, entries[0][1].size(-1)), dtype=compute_dtype, device=device)
+    for row, (_, states) in enumerate(entries):
+        hidden[row, :len(states)] = states.to(device, hidden.dtype)
+    return texts, encoded, hidden
+
+
+def decode_tasks(texts, hidden, word_ids, offsets, tasks):
+    """Run the requested heads on hidden states of shape (batch, seq_len, d_model) and decode each row."""
+    multitask = get_multitask(tasks)
+    with torch.no_grad():
+        # One vector per whitespace word, so every head predicts one label per word
+        word_hidden = pool_words(hidden, word_ids.to(device), WORD_POOLING)
+        outputs = multitask.run_heads(word_hidden, tasks=tasks)  # Only the small task heads run per task
+        predictions = {task: torch.argmax(logits, dim=-1).cpu().numpy() for task, logits in outputs.items()}  # Get the predicted labels
+
+    words = word_spans(word_ids.numpy(), offsets.numpy())
+    decoded = {task: task_decoders[task](texts, words, predictions[task]) for task in tasks}
+    return [{task: decoded[task][row] for task in tasks} for row in range(len(texts))]
+
+
+def run_tasks(texts, tasks):
+    """Encode a batch once with the shared backbone and decode every requested task head."""
+    texts, encoded, hidden = encode_hidden(texts)
+    return decode_tasks(texts, hidden, encoded["word_ids"], encoded["offsets"], tasks)
+
+
+def stream_tasks(text, tasks):
+    """Results for one document window by window, each yielded as soon as its window is encoded.
+
+    Every window reports the words whose first token lies in the part of the window it owns (the
+    same centre-of-window split run_tasks stitches with), with character offsets into the whole
+    text. An entity running across the boundary of two windows comes back as two spans.
+    """
+    tokenizer, model = get_tokenizer(), get_model()
+    encoded = tokenizer.encode_batch(
+        [normalize(text)], max_length=MAX_DOCUMENT_TOKENS, return_offsets=True, return_word_ids=True
+    )
+    offsets = torch.from_numpy(original_offsets([text], encoded["offsets"]))[0]
+    input_ids, word_ids = encoded["input_ids"][0], encoded["word_ids"][0]
+    window_length = min(MAX_LENGTH, len(input_ids))
+    plan = window_plan(len(input_ids) - 2, window_length, WINDOW_OVERLAP)
+    windows = make_windows(input_ids, plan, tokenizer.cls_token_id, tokenizer.sep_token_id, window_length)
+
+    # Document token positions where a new word starts (subwords of a word are contiguous)
+    content_words = word_ids[1:-1]
+    first_token = torch.ones_like(content_words, dtype=torch.bool)
+    first_token[1:] = content_words[1:] != content_words[:-1]
+
+    for index, (start, lo, hi) in enumerate(plan):
+        window = windows[index:index + 1].to(device)
+        with torch.no_grad():
+            hidden = model(window, torch.ones_like(window)).to(compute_dtype)
+
+        # Word ids of the window's tokens, renumbered from 0 and -1 outside the words it owns
+        owned = content_words[lo:hi][first_token[lo:hi]]
+        window_word_ids = word_ids[start:start + window_length].clone()
+        window_word_ids[0] = window_word_ids[-1] = -1  # the window's CLS/SEP
+        if len(owned):
+            in_window = (window_word_ids >= owned[0]) & (window_word_ids <= owned[-1])
+            window_word_ids = torch.where(in_window, window_word_ids - owned[0], -1)
+        else:
+            window_word_ids.fill_(-1)
+        result = decode_tasks([text], hidden, window_word_ids[None], offsets[None, start:start + window_length], tasks)[0]
+        yield {"window": index, "windows": len(plan), **result}
+
+
+def embed(texts, pooling, project, cache=True):
+    """Sentence vectors (batch, d_model) as float32 numpy, pooled from the backbone's hidden states."""
+    texts, encoded, hidden = encode_hidden(texts, cache=cache)
+    with torch.no_grad():
+        pooled = pool_sentences(hidden, encoded["attention_mask"].to(device), pooling)
+        if project:
+            pooled = get_model().project(pooled)
+    return pooled.float().cpu().numpy()
+
+
+def run_embed(requests):
+    """Embed (text, pooling, project, normalize) requests, one backbone pass for the whole batch."""
+    results = [None] * len(requests)
+    for options in set(request[1:] for request in requests):
+        rows = [row for row, request in enumerate(requests) if request[1:] == options]
+        pooling, project, normalize = options
+        vectors = embed([requests[row][0] for row in rows], pooling, project)
+        if normalize:
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        for row, vector in zip(rows, vectors):
+            results[row] = vector.tolist()
+    return results
+
+
+def run_index_embed(texts):
+    """Vectors for the search index; ingested documents don't go through the hidden-state cache."""
+    return list(embed(texts, INDEX_POOLING, INDEX_PROJECT, cache=False))
+
+
+def run_ner(texts):
+    return [result["ner"] for result in run_tasks(texts, ["ner"])]
+
+
+def run_pos(texts):
+    return [result["pos"] for result in run_tasks(texts, ["pos"])]
+
+
+def run_analyze(texts):
+    return run_tasks(texts, list(task_decoders))
+
+
+# Concurrent requests are gathered into one padded forward pass per endpoint
+MAX_BATCH_SIZE = int(os.environ.get("SABDA_MAX_BATCH_SIZE", 16))
+MAX_WAIT_MS = float(os.environ.get("SABDA_MAX_WAIT_MS", 5))
+# Requests waiting per endpoint before new ones are turned away with 429
+MAX_PENDING = int(os.environ.get("SABDA_MAX_PENDING", 256))
+
+# Every forward pass runs on this fixed pool instead of the request threadpool. The workers share the
+# weights; torch's intra-op threads are split between them so concurrent batches don't oversubscribe
+# the cores.
+INFERENCE_WORKERS = int(os.environ.get("SABDA_INFERENCE_WORKERS", 2))
+TORCH_THREADS = int(os.environ.get("SABDA_TORCH_THREADS", max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS)))
+if device.type == "cpu":
+    torch.set_num_threads(TORCH_THREADS)
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+# /analyze/stream runs its windows on the same pool one at a time; beyond this many streams at once
+# new ones get 429, so long documents can't hold every worker while the batched endpoints wait
+MAX_STREAMS = int(os.environ.get("SABDA_MAX_STREAMS", max(1, INFERENCE_WORKERS // 2)))
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+stream_stats = {"max_streams": MAX_STREAMS, "active": 0, "total": 0, "rejected": 0}
+
+# Semantic search over ingested documents; the same pooling embeds documents and queries
+INDEX_POOLING = os.environ.get("SABDA_INDEX_POOLING", "mean")
+INDEX_PROJECT = os.environ.get("SABDA_INDEX_PROJECT", "0") == "1"
+vector_index = IVFIndex(
+    os.environ.get("SABDA_INDEX_DIR", "index"),
+    dim=768,
+    nlist=int(os.environ.get("SABDA_INDEX_NLIST", 1024)),
+    nprobe=int(os.environ.get("SABDA_INDEX_NPROBE", 16)),
+)
+
+# Loaded before the server reports ready: comma-separated registry names, or "all"
+PRELOAD = os.environ.get("SABDA_PRELOAD", "")
+# Padded lengths (tokens) run once through the backbone and the preloaded heads at startup
+WARMUP_LENGTHS = [int(length) for length in os.environ.get("SABDA_WARMUP_LENGTHS", "").split(",") if length]
+
+
+def preload(names):
+    """Load registry entries ahead of the first request; "all" is the tokenizer, the backbone and every head."""
+    if names == "all":
+        names = ["tokenizer", "token_table", "multitask", *task_models]
+    for name in names:
+        registry.get(name)
+
+
+def warmup(lengths):
+    """One forward pass per length so the first requests don't pay for allocator growth and kernel selection."""
+    tokenizer, model = get_tokenizer(), get_model()
+    tasks = [task for task in task_decoders if registry.loaded(task)]
+    generator = torch.Generator().manual_seed(0)
+    for length in lengths:
+        length = padded_width(length)
+        start = time.perf_counter()
+        input_ids = torch.randint(tokenizer.get_vocab_size(), (1, length), generator=generator)
+        input_ids[0, 0], input_ids[0, -1] = tokenizer.cls_token_id, tokenizer.sep_token_id
+        with torch.no_grad():
+            hidden = model(input_ids.to(device), torch.ones_like(input_ids).to(device)).to(compute_dtype)
+            if tasks:
+                get_multitask(tasks).run_heads(hidden, tasks=tasks)
+        print(f"Warmed up {length} tokens in {time.perf_counter() - start:.3f}s")
+
+
+startup = {"ready": False, "seconds": None, "error": None}
+
+
+def prepare():
+    """Preload and warm up as configured, timing the whole startup for /ready."""
+    start = time.perf_counter()
+    try:
+        preload(PRELOAD if PRELOAD == "all" else [name for name in PRELOAD.split(",") if name])
+        if WARMUP_LENGTHS:
+            warmup(WARMUP_LENGTHS)
+    except Exception as e:
+        startup["error"] = repr(e)
+        raise
+    startup["seconds"] = time.perf_counter() - start
+    startup["ready"] = True
+    print(f"Ready in {startup['seconds']:.3f}s")
+
+
+batching = dict(max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, executor=inference_executor, max_pending=MAX_PENDING)
+batchers = {
+    "fill-mask": MicroBatcher(run_fill_mask, **batching),
+    "fill-mask-iterative": MicroBatcher(run_fill_mask_iterative, **batching),
+    "ner": MicroBatcher(run_ner, **batching),
+    "pos": MicroBatcher(run_pos, **batching),
+    "analyze": MicroBatcher(run_analyze, **batching),
+    "embed": MicroBatcher(run_embed, **batching),
+    "index": MicroBatcher(run_index_embed, **batching),
+}
+
+
+@app.exception_handler(QueueFull)
+async def queue_full(request, exc):
+    return JSONResponse(status_code=429, content={"detail": f"Server busy: {exc}"}, headers={"Retry-After": "1"})
 
+
+@app.post("/fill-mask", response_model=List[tuple])
+async def predict_masked_tokens(request: MaskRequest):
+    text = request.text
+
+    if not text:
+        raise HTTPException(status_code=400, detail="Empty text received")
+    if request.strategy == "parallel":
+        predictions = await batchers["fill-mask"].submit(text)
+    elif request.strategy == "iterative":
+        predictions = await batchers["fill-mask-iterative"].submit((text, request.beam_size))
+    else:
+        raise HTTPException(status_code=400, detail=f"Unknown strategy: {request.strategy}")
+
+    if predictions is None:
+        raise HTTPException(status_code=400, detail="No mask token found in the input text")
     return predictions
 
 
 @app.post("/ner", response_model=List[EntityResponse])
-def predict_entities(request: TextRequest):
-    devices()
+async def predict_entities(request: TextRequest):
     text = request.text
     if not text:
         raise HTTPException(status_code=400, detail="Empty text received")
-    # Tokenize the input text using the Nepali tokenizer
-    with torch.no_grad():
-        tokens = tokenizer.encode(text)
-        outputs = nermodel(tokens['input_ids'].unsqueeze(0).to(device),
-                           tokens['attention_mask'].unsqueeze(0).to(device))  # Forward pass through the model
-        predictions = torch.argmax(outputs, dim=-1).squeeze().tolist()  # Get the predicted labels
-        predictions = predictions[1:sum(tokens['attention_mask'].tolist())]  # Remove the [CLS] and [SEP] tokens
-        entities = []
-        i = 1
-        while i < len(predictions):
-            pred = predictions[i]
-            if pred in ner_idx2label:
-                token_id = [tokens['input_ids'][i].item()]
-                current_text = tokenizer.decode(token_id)
-                current_type = ner_idx2label[pred]
-                
-                # Look ahead for ##
-                next_idx = i + 1
-                while (next_idx < len(predictions) and tokenizer.decode([tokens['input_ids'][next_idx].item()]).startswith('##')):
-                    # Merge with the current token
-                    next_token = tokenizer.decode([tokens['input_ids'][next_idx].item()])
-                    current_text += next_token.replace('##', '')
-                    i = next_idx
-                    next_idx += 1
-                
-                entities.append({
-                    "text": current_text,
-                    "type": current_type
-                })
-            i += 1
-        return entities
-
-    
+    return await batchers["ner"].submit(text)
 
 
 @app.post("/pos", response_model=List[EntityResponse])
-def predict_entities(request: TextRequest):
-    devices()
+async def predict_pos(request: TextRequest):
     text = request.text
     if not text:
         raise HTTPException(status_code=400, detail="Empty text received")
-    # Tokenize the input text using the Nepali tokenizer
-    
-    with torch.no_grad():
-        tokens = tokenizer.encode(text)
-        outputs = posmodel(tokens['input_ids'].unsqueeze(0).to(device),
-                           tokens['attention_mask'].unsqueeze(0).to(device))  # Forward pass through the model
-        predictions = torch.argmax(outputs, dim=-1).squeeze().tolist()  # Get the predicted labels
-        all_preds = [pos_idx2label[idx] for idx in predictions]
-        all_preds = all_preds[1:sum(tokens['attention_mask'].tolist()) - 1]  # Remove the [CLS] and [SEP] tokens
-        entities = []
-        for i, pred in enumerate(all_preds):
-            token_id = [tokens['input_ids'][i + 1].item()]
-            text = tokenizer.decode(token_id)
-            entities.append({
-                "text": text,
-                "type": pred
-            })
-        return entities
+    return await batchers["pos"].submit(text)
+
+
+@app.post("/analyze", response_model=AnalyzeResponse)
+async def analyze(request: TextRequest):
+    """NER and POS tags from a single backbone pass."""
+    text = request.text
+    if not text:
+        raise HTTPException(status_code=400, detail="Empty text received")
+    return await batchers["analyze"].submit(text)
+
+
+@app.post("/analyze/stream")
+async def analyze_stream(request: StreamRequest):
+    """NER/POS results of a long document as newline-delimited JSON, one line per window."""
+    if not request.text:
+        raise HTTPException(status_code=400, detail="Empty text received")
+    unknown = [task for task in request.tasks if task not in task_decoders]
+    if unknown or not request.tasks:
+        raise HTTPException(status_code=400, detail=f"Unknown tasks: {unknown}")
+    if not stream_slots.acquire(blocking=False):
+        stream_stats["rejected"] += 1
+        raise QueueFull(f"{MAX_STREAMS} streams already running")
+    stream_stats["active"] += 1
+    stream_stats["total"] += 1
+    results = stream_tasks(request.text, request.tasks)
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            stream_stats["active"] -= 1
+            stream_slots.release()
+
+    async def lines():
+        # Each window is encoded on the inference pool, like the batched endpoints
+        loop = asyncio.get_running_loop()
+        try:
+            while (result := await loop.run_in_executor(inference_executor, next, results, None)) is not None:
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            # Also when the client disconnects mid-stream
+            release()
+
+    # The background task covers a client gone before the first line, when lines() never starts
+    return StreamingResponse(lines(), media_type="application/x-ndjson", background=BackgroundTask(release))
+
+
+@app.post("/embed", response_model=List[List[float]])
+async def embed_texts(request: EmbedRequest):
+    """One vector per text, in request order."""
+    if request.pooling not in ("cls", "mean"):
+        raise HTTPException(status_code=400, detail=f"Unknown pooling: {request.pooling}")
+    if not all(request.texts):
+        raise HTTPException(status_code=400, detail="Empty text received")
+    options = (request.pooling, request.project, request.normalize)
+    return await batchers["embed"].submit_many([(text, *options) for text in request.texts])
+
+
+@app.post("/ingest")
+async def ingest(request: IngestRequest):
+    """Embed documents and append them to the search index."""
+    if not all(document.text for document in request.documents):
+        raise HTTPException(status_code=400, detail="Empty text received")
+    # Nothing is added to the index unless every document was embedded
+    vectors = await batchers["index"].submit_many([document.text for document in request.documents])
+    count = await run_in_threadpool(
+        vector_index.add,
+        [document.id for document in request.documents],
+        [document.text for document in request.documents],
+        np.stack(vectors),
+    )
+    return {"ingested": len(request.documents), "count": count}
+
+
+@app.post("/search", response_model=List[SearchResult])
+async def search(request: SearchRequest):
+    """The k ingested documents closest to the text, by cosine similarity."""
+    if not request.text:
+        raise HTTPException(status_code=400, detail="Empty text received")
+    query = await batchers["index"].submit(request.text)
+    hits = (await run_in_threadpool(vector_index.search, query, request.k, request.nprobe))[0]
+    return [{**vector_index.document(number), "score": score} for number, score in hits]
+
+
+@app.get("/ready")
+def ready():
+    """200 once the preloaded models are loaded and warmed up, 503 before (or if that failed)."""
+    return JSONResponse(
+        status_code=200 if startup["ready"] else 503,
+        content={**startup, "models": registry.stats()},
+    )
+
+
+@app.get("/metrics/batching")
+def batching_metrics():
+    return {**{name: batcher.stats() for name, batcher in batchers.items()}, "stream": dict(stream_stats)}
+
+
+@app.get("/metrics/cache")
+def cache_metrics():
+    return hidden_cache.stats()
+
 
+@app.get("/metrics/index")
+def index_metrics():
+    return vector_index.stats()
 
 
 if __name__ == "__main__":
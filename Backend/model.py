@@ -1,5 +1,8 @@
+from typing import Optional
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 
 # class NepaliTransformer(nn.Module):
@@ -42,7 +45,10 @@ class NepaliTransformer(nn.Module):
         super().__init__()
         self.embedding = nn.Embedding(vocab_size, d_model)
         self.position = nn.Embedding(max_len, d_model)
-        
+        self.num_heads = num_heads
+        # Recompute each encoder layer's activations in backward instead of storing them (training only)
+        self.gradient_checkpointing = False
+
         self.encoder_layers = nn.ModuleList([
             nn.TransformerEncoderLayer(
                 d_model=d_model,
@@ -56,28 +62,71 @@ class NepaliTransformer(nn.Module):
         self.lm_head = nn.Linear(d_model, vocab_size)
         self.cls_head = nn.Linear(d_model, d_model)  # Optional projection
 
-    def forward(self, x, attention_mask):
+    def forward(self, x, attention_mask, position_ids: Optional[torch.Tensor] = None,
+                segment_ids: Optional[torch.Tensor] = None, lm_positions: Optional[torch.Tensor] = None):
+        """
+        Args:
+            position_ids: Optional per-token positions, e.g. restarting at 0 for every packed document
+            segment_ids: Optional per-token document ids of packed rows; tokens only attend within their
+                own segment (block-diagonal attention). Padding should be a segment of its own.
+            lm_positions: Optional (row, position) pairs; if given, returns lm_head logits for those
+                positions only instead of the hidden states (MLM training under DDP goes through forward)
+        """
         # Add [CLS] token position (always position 0)
-        positions = torch.arange(x.size(1), device=x.device).expand(x.size(0), -1)
-        x = self.embedding(x) + self.position(positions)
-        
-        pad_mask = (attention_mask == 0)
-        
+        if position_ids is None:
+            position_ids = torch.arange(x.size(1), device=x.device).expand(x.size(0), -1)
+        x = self.embedding(x) + self.position(position_ids)
+
+        pad_mask: Optional[torch.Tensor] = None
+        block_mask: Optional[torch.Tensor] = None
+        if segment_ids is None:
+            pad_mask = (attention_mask == 0)
+        else:
+            # (batch * heads, seq, seq) mask, True where attention crosses a document boundary
+            block_mask = segment_ids.unsqueeze(2) != segment_ids.unsqueeze(1)
+            block_mask = block_mask.repeat_interleave(self.num_heads, dim=0)
+
         for layer in self.encoder_layers:
-            x = layer(x, src_key_padding_mask=pad_mask)
-        
+            if self.gradient_checkpointing and self.training and not torch.jit.is_scripting():
+                x = self._checkpointed_layer(layer, x, block_mask, pad_mask)
+            else:
+                x = layer(x, src_mask=block_mask, src_key_padding_mask=pad_mask)
+
+        if lm_positions is not None:
+            return self.lm_logits(x, lm_positions)
         return x
     
+    @torch.jit.unused
+    def _checkpointed_layer(self, layer, x, src_mask, pad_mask):
+        return checkpoint(layer, x, src_mask, pad_mask, use_reentrant=False)
+
+    def project(self, pooled):
+        """Sentence vectors through cls_head, e.g. pooled with pool_sentences."""
+        return self.cls_head(pooled)
+
     def lm_token(self, x,attention_mask):
-        positions = torch.arange(x.size(1), device=x.device).expand(x.size(0), -1)
-        x = self.embedding(x) + self.position(positions)
-        
-        pad_mask = (attention_mask == 0)
-        
-        for layer in self.encoder_layers:
-            x = layer(x, src_key_padding_mask=pad_mask)
-        
-        return self.lm_head(x)
+        return self.lm_head(self.forward(x, attention_mask))
+
+    def lm_logits(self, hidden, positions):
+        """Project only the selected positions through lm_head.
+
+        Args:
+            hidden: Hidden states from forward, shape (batch, seq_len, d_model)
+            positions: (row, position) pairs of shape (n, 2), e.g. from ``(x == mask_id).nonzero()``
+        """
+        return self.lm_head(hidden[positions[:, 0], positions[:, 1]])
+
+    def mask_predictions(self, x, attention_mask, mask_token_id, k=5):
+        """Top-k tokens for every mask position, with probabilities normalised over the full vocabulary.
+
+        Returns the (row, position) pairs of the masks, the top-k probabilities and the top-k token ids,
+        one row per mask in reading order.
+        """
+        hidden = self.forward(x, attention_mask)
+        positions = (x == mask_token_id).nonzero()
+        log_probs = torch.log_softmax(self.lm_logits(hidden, positions).float(), dim=-1)
+        top_log_probs, top_ids = torch.topk(log_probs, k, dim=-1)
+        return positions, top_log_probs.exp(), top_ids
     
 class NERModel(nn.Module):
     def __init__(self, embedding_model, hidden_dim, num_classes, dropout_rate=0.3):
@@ -93,6 +142,10 @@ class NERModel(nn.Module):
     
     def forward(self, x, attention_mask):
         embedded = self.embedding.forward(x, attention_mask)
+        return self.head(embedded)
+
+    def head(self, embedded):
+        """Task layers only, for hidden states already computed by the embedding model."""
         embedded = self.dropout(embedded)
         logits = self.fc1(embedded)
         logits = self.relu(logits)
@@ -114,9 +167,79 @@ class POSModel(nn.Module):
     
     def forward(self, x, attention_mask):
         embedded = self.embedding.forward(x, attention_mask)
+        return self.head(embedded)
+
+    def head(self, embedded):
+        """Task layers only, for hidden states already computed by the embedding model."""
         embedded = self.dropout(embedded)
         logits = self.fc1(embedded)
         logits = self.relu(logits)
         logits = self.dropout(logits)
         logits = self.fc2(logits)
-        return logits
\ No newline at end of file
+        return logits
+
+
+class MultiTaskModel(nn.Module):
+    """Runs the shared embedding model once and every requested task head on its hidden states.
+
+    Any module with a ``head(embedded)`` method (NERModel, POSModel, ...) can be registered as a task.
+    """
+    def __init__(self, embedding_model, heads):
+        super(MultiTaskModel, self).__init__()
+        self.embedding = embedding_model
+        self.heads = nn.ModuleDict(heads)
+
+    def forward(self, x, attention_mask, tasks=None):
+        embedded = self.embedding.forward(x, attention_mask)
+        return self.run_heads(embedded, tasks)
+
+    def run_heads(self, embedded, tasks=None):
+        tasks = list(self.heads.keys()) if tasks is None else tasks
+        return {task: self.heads[task].head(embedded) for task in tasks}
+
+
+def pool_words(hidden, word_ids, mode="first"):
+    """Pool subword hidden states into one vector per word, on the device the states are on.
+
+    Args:
+        hidden: Token hidden states of shape (batch, seq_len, d_model)
+        word_ids: Word index of every token, shape (batch, seq_len), -1 for special and padding tokens
+        mode: "first" takes each word's first subword, "mean" averages all of its subwords
+
+    Returns word states of shape (batch, num_words, d_model), num_words being the most words in any row;
+    rows with fewer words are zero-padded.
+    """
+    batch_size, _, d_model = hidden.shape
+    num_words = int(word_ids.max()) + 1 if word_ids.numel() else 0
+    valid = word_ids >= 0
+    # Special and padding tokens go to an extra slot that is dropped at the end
+    index = torch.where(valid, word_ids, torch.full_like(word_ids, num_words))
+    if mode == "first":
+        previous = torch.nn.functional.pad(word_ids[:, :-1], (1, 0), value=-1)
+        index = torch.where(word_ids != previous, index, torch.full_like(index, num_words))
+    elif mode != "mean":
+        raise ValueError(f"Unknown pooling mode {mode!r}, expected 'first' or 'mean'")
+
+    pooled = hidden.new_zeros(batch_size, num_words + 1, d_model)
+    pooled.index_put_((torch.arange(batch_size, device=hidden.device).unsqueeze(1), index), hidden, accumulate=True)
+    if mode == "mean":
+        counts = hidden.new_zeros(batch_size, num_words + 1)
+        counts.index_put_((torch.arange(batch_size, device=hidden.device).unsqueeze(1), index), valid.to(hidden.dtype), accumulate=True)
+        pooled = pooled / counts.clamp(min=1).unsqueeze(-1)
+    return pooled[:, :num_words]
+
+
+def pool_sentences(hidden, attention_mask, mode="cls"):
+    """One vector per sequence: the CLS state, or the mean over the real (attention_mask) tokens.
+
+    Args:
+        hidden: Token hidden states of shape (batch, seq_len, d_model)
+        attention_mask: 1 for real tokens and 0 for padding, shape (batch, seq_len)
+        mode: "cls" or "mean"
+    """
+    if mode == "cls":
+        return hidden[:, 0]
+    if mode != "mean":
+        raise ValueError(f"Unknown pooling mode {mode!r}, expected 'cls' or 'mean'")
+    mask = attention_mask.to(hidden.dtype).unsqueeze(-1)
+    return (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
@@ -1,5 +1,7 @@
-from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from tokenizers import Tokenizer, models, pre_tokenizers, processors, trainers
 import os
+import threading
+import numpy as np
 import torch
 
 class NepaliTokenizer:
@@ -14,6 +16,14 @@ class NepaliTokenizer:
         self.sep_token_id = self.tokenizer.token_to_id("<sep>")
         self.mask_token_id = self.tokenizer.token_to_id("<mask>")
 
+        # The Rust side adds CLS/SEP, truncates and pads; its settings are shared by all threads
+        self.tokenizer.post_processor = processors.TemplateProcessing(
+            single="<cls> $A <sep>",
+            special_tokens=[("<cls>", self.cls_token_id), ("<sep>", self.sep_token_id)],
+        )
+        self._lock = threading.Lock()
+        self._batch_config = None
+
     def _build_tokenizer(self):
         self.tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
         
@@ -24,7 +34,7 @@ class NepaliTokenizer:
         )
         
         self.tokenizer.train(["/home/ubuntu/dataset/new_final_single_col.tsv"], trainer=trainer)
-        self.tokenizer.enable_padding(pad_id=self.pad_token_id, pad_token="<pad>")
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id("<pad>"), pad_token="<pad>")
         self.tokenizer.enable_truncation(max_length=512)
 
         # Save the trained tokenizer
@@ -43,30 +53,57 @@ class NepaliTokenizer:
 
     def encode(self, text, max_length=512):
         """Encode text with CLS and SEP tokens, add attention mask, and apply padding."""
-        # Encode the text
-        encoding = self.tokenizer.encode(text)
-        tokens = encoding.ids
-    
-        # Truncate if needed (leaving room for CLS and SEP)
-        if len(tokens) > max_length - 2:  # -2 for CLS and SEP
-            tokens = tokens[:(max_length - 2)]
-    
-        # Add CLS and SEP tokens
-        tokens = [self.cls_token_id] + tokens + [self.sep_token_id]
-    
-        # Create attention mask (1 for real tokens, 0 for padding)
-        attention_mask = [1] * len(tokens)
-    
-        # Apply padding if necessary
-        padding_length = max_length - len(tokens)
-        if padding_length > 0:
-            tokens += [self.pad_token_id] * padding_length
-            attention_mask += [0] * padding_length  # 0 for padded tokens
-    
+        encoded = self.encode_batch([text], max_length=max_length, pad_to_multiple_of=max_length)
         return {
-            "input_ids": torch.tensor(tokens,dtype=torch.long),
-            "attention_mask": torch.tensor(attention_mask,dtype=torch.long)
+            "input_ids": encoded["input_ids"][0],
+            "attention_mask": encoded["attention_mask"][0]
         }
-    
+
+    def _configure(self, max_length, pad_to_multiple_of):
+        if self._batch_config != (max_length, pad_to_multiple_of):
+            self.tokenizer.enable_truncation(max_length=max_length)
+            self.tokenizer.enable_padding(
+                pad_id=self.pad_token_id, pad_token="<pad>", pad_to_multiple_of=pad_to_multiple_of
+            )
+            self._batch_config = (max_length, pad_to_multiple_of)
+
+    def encode_batch(self, texts, max_length=512, pad_to_multiple_of=None, return_offsets=False, return_word_ids=False):
+        """Encode a batch of texts with CLS and SEP tokens, padding only to the longest sequence in the batch.
+
+        Tokenization, special tokens, truncation and padding all run in the Rust tokenizer, in parallel
+        across the batch; the ids come back as one array without per-token Python work.
+        With return_offsets, "offsets" holds each token's (start, end) character span in its text,
+        (0, 0) for special and padding tokens. With return_word_ids, "word_ids" holds the index of the
+        whitespace word each token belongs to, -1 for special and padding tokens.
+        """
+        with self._lock:
+            self._configure(max_length, pad_to_multiple_of)
+            encodings = self.tokenizer.encode_batch(texts)
+
+        # Rounding up to pad_to_multiple_of may overshoot max_length, which the position table can't take
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)[:, :max_length]
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)[:, :max_length]
+        output = {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy(attention_mask)
+        }
+        if return_offsets:
+            offsets = np.array([encoding.offsets for encoding in encodings], dtype=np.int64).reshape(len(texts), -1, 2)
+            output["offsets"] = torch.from_numpy(offsets[:, :max_length])
+        if return_word_ids:
+            # None (special/padding) becomes NaN in a float array, then -1
+            word_ids = np.array([encoding.word_ids for encoding in encodings], dtype=np.float64)[:, :max_length]
+            output["word_ids"] = torch.from_numpy(np.nan_to_num(word_ids, nan=-1).astype(np.int64))
+        return output
+
+    def encode_ids(self, texts):
+        """Token ids of each text without special tokens, truncation or padding, for corpus preprocessing."""
+        with self._lock:
+            self.tokenizer.no_truncation()
+            self.tokenizer.no_padding()
+            self._batch_config = None
+            encodings = self.tokenizer.encode_batch(texts, add_special_tokens=False)
+        return [encoding.ids for encoding in encodings]
+
     def decode(self, tokens):
         return self.tokenizer.decode(tokens)
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""Tokenize a text corpus once into flat uint16 token shards for pretraining.
+
+    python pretokenize.py /home/ubuntu/dataset/new_final_single_col.tsv --out_dir data/pretokenized
+
+Every input line is one document. Documents are tokenized in parallel across processes (without
+CLS/SEP, which are added when sequences are built) and appended to shard_XXXXX.bin files of raw
+uint16 ids. Each shard has a shard_XXXXX.idx.npy index of document offsets (num_docs + 1 int64
+values), and index.json lists all shards. dataset.PretokenizedDataset memory-maps the result.
+"""
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from nepalitokenizer import NepaliTokenizer
+
+_tokenizer = None
+
+
+def _init_worker(tokenizer_path):
+    global _tokenizer
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"  # one process per core already
+    _tokenizer = NepaliTokenizer(load_path=tokenizer_path)
+
+
+def _tokenize_chunk(texts):
+    ids = _tokenizer.encode_ids(texts)
+    lengths = np.fromiter((len(doc) for doc in ids), dtype=np.int64, count=len(ids))
+    tokens = np.fromiter((token for doc in ids for token in doc), dtype=np.uint16, count=int(lengths.sum()))
+    return tokens, lengths
+
+
+def read_documents(paths, column=None, skip_header=False, chunk_docs=2000):
+    """Yield lists of documents from the input files without loading them into memory."""
+    chunk = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            if skip_header:
+                next(f, None)
+            for line in f:
+                text = line.rstrip("\n")
+                if column is not None:
+                    fields = text.split("\t")
+                    text = fields[column] if column < len(fields) else ""
+                if not text.strip():
+                    continue
+                chunk.append(text)
+                if len(chunk) == chunk_docs:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+class ShardWriter:
+    def __init__(self, out_dir, shard_tokens):
+        self.out_dir = out_dir
+        self.shard_tokens = shard_tokens
+        self.shards = []
+        self._file = None
+
+    def _open_shard(self):
+        name = f"shard_{len(self.shards):05d}"
+        self._file = open(os.path.join(self.out_dir, name + ".bin"), "wb")
+        self._offsets = [np.zeros(1, dtype=np.int64)]
+        self._num_tokens = 0
+        self.shards.append({"tokens": name + ".bin", "offsets": name + ".idx.npy"})
+
+    def _close_shard(self):
+        self._file.close()
+        offsets = np.concatenate(self._offsets)
+        np.save(os.path.join(self.out_dir, self.shards[-1]["offsets"]), offsets)
+        self.shards[-1].update(num_docs=len(offsets) - 1, num_tokens=int(offsets[-1]))
+        self._file = None
+
+    def write(self, tokens, lengths):
+        if self._file is None:
+            self._open_shard()
+        self._file.write(tokens.tobytes())
+        self._offsets.append(self._num_tokens + np.cumsum(lengths))
+        self._num_tokens += len(tokens)
+        if self._num_tokens >= self.shard_tokens:
+            self._close_shard()
+
+    def close(self):
+        if self._file is not None:
+            self._close_shard()
+
+
+def main(args):
+    tokenizer = NepaliTokenizer(load_path=args.tokenizer)
+    if tokenizer.get_vocab_size() > np.iinfo(np.uint16).max:
+        raise ValueError("Vocabulary does not fit in uint16 token shards")
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    writer = ShardWriter(args.out_dir, args.shard_tokens)
+    chunks = read_documents(args.inputs, args.column, args.skip_header, args.chunk_docs)
+    start = time.perf_counter()
+    num_docs = num_tokens = 0
+    with Pool(args.workers, initializer=_init_worker, initargs=(args.tokenizer,)) as pool:
+        # imap keeps the input order, so shard contents are reproducible across runs
+        for tokens, lengths in pool.imap(_tokenize_chunk, chunks):
+            writer.write(tokens, lengths)
+            num_docs += len(lengths)
+            num_tokens += len(tokens)
+            if num_docs % (args.chunk_docs * 50) == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{num_docs} docs | {num_tokens} tokens | {num_tokens / elapsed:.0f} tokens/s")
+    writer.close()
+
+    index = {
+        "dtype": "uint16",
+        "vocab_size": tokenizer.get_vocab_size(),
+        "pad_token_id": tokenizer.pad_token_id,
+        "cls_token_id": tokenizer.cls_token_id,
+        "sep_token_id": tokenizer.sep_token_id,
+        "mask_token_id": tokenizer.mask_token_id,
+        "num_docs": num_docs,
+        "num_tokens": num_tokens,
+        "shards": writer.shards,
+    }
+    with open(os.path.join(args.out_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {num_docs} docs / {num_tokens} tokens in {len(writer.shards)} shards ({elapsed:.1f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-tokenize a corpus into memory-mappable uint16 shards")
+    parser.add_argument("inputs", nargs="+", help="Text or TSV files, one document per line")
+    parser.add_argument("--out_dir", default="data/pretokenized")
+    parser.add_argument("--tokenizer", default="nepali_tokenizer.json")
+    parser.add_argument("--column", default=None, type=int, help="TSV column holding the text (whole line if unset)")
+    parser.add_argument("--skip_header", action="store_true")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int, help="Tokenizer processes")
+    parser.add_argument("--chunk_docs", default=2000, type=int, help="Documents sent to a worker at a time")
+    parser.add_argument("--shard_tokens", default=2**28, type=int, help="Tokens per shard before starting a new one")
+    main(parser.parse_args())
@@ -0,0 +1,174 @@
+"""Reduced-precision inference for NepaliTransformer and its task heads.
+
+int8: dynamic quantization of every nn.Linear (feed-forward layers, lm_head and the NER/POS heads),
+      CPU only. Attention in/out projections stay fp32 since PyTorch keeps them as packed parameters.
+bf16: casts the weights to bfloat16, used only where the hardware supports it natively.
+
+    python quantize.py --out models/snapshot.int8.pt     # write an int8 checkpoint from models/*.pt
+    python quantize.py --check --precision int8          # accuracy regression against fp32
+"""
+import argparse
+import copy
+import os
+import sys
+
+import torch
+import torch.nn as nn
+
+from model import NepaliTransformer, NERModel, POSModel, MultiTaskModel
+from nepalitokenizer import NepaliTokenizer
+
+PRECISIONS = ("fp32", "int8", "bf16")
+
+CHECK_TEXTS = [
+    "नेपालको राजधानी काठमाडौं हो ।",
+    "प्रधानमन्त्रीले आज मन्त्रिपरिषद्को बैठक बोलाउनुभएको छ ।",
+    "नेपाल राष्ट्र बैंकले नयाँ मौद्रिक नीति सार्वजनिक गरेको छ ।",
+    "राम बिहानै बजार गयो र तरकारी किनेर फर्कियो ।",
+    "सगरमाथा संसारकै सबैभन्दा अग्लो हिमाल हो ।",
+    "पोखरामा आयोजित प्रतियोगितामा त्रिभुवन विश्वविद्यालयको टोली विजयी भयो ।",
+    "नयाँ सरकार गठनपछि मुलुकमा राजनीतिक स्थायित्व हुने दाबी गरिएको छ ।",
+    "भक्तपुरको ख्वप इन्जिनियरिङ कलेजमा विद्यार्थीहरूले नयाँ परियोजना प्रस्तुत गरे ।",
+]
+
+
+def bf16_supported(device):
+    """Whether the device has native bfloat16 matmuls (on CPU: AVX512-BF16 or AMX)."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def quantize_int8(module):
+    """Dynamically quantize every nn.Linear of module to int8, in place."""
+    torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    for layer in module.modules():
+        if isinstance(layer, nn.TransformerEncoderLayer):
+            # The fused encoder fast path reads linear1.weight as a tensor, which quantized layers
+            # don't have; any forward hook makes the layer take the regular path instead
+            layer.register_forward_pre_hook(lambda layer, args: None)
+    return module
+
+
+def apply_precision(module, precision, device):
+    """Convert module in place and return the precision actually used."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    if precision == "int8":
+        if torch.device(device).type != "cpu":
+            print(f"int8 dynamic quantization runs on CPU only, keeping fp32 on {device}")
+            return "fp32"
+        quantize_int8(module)
+    elif precision == "bf16":
+        if not bf16_supported(device):
+            print(f"bf16 is not natively supported on {device}, keeping fp32")
+            return "fp32"
+        module.to(torch.bfloat16)
+    return precision
+
+
+def save_quantized(multitask, path):
+    """Save an int8 MultiTaskModel as one file: the backbone once plus each head without it."""
+    # Per-layer state dicts keep the version metadata the quantized layers need when loading
+    heads = {
+        task: {name: layer.state_dict() for name, layer in head.named_children() if name != "embedding"}
+        for task, head in multitask.heads.items()
+    }
+    torch.save({"PRECISION": "int8", "MODEL_STATE": multitask.embedding.state_dict(), "HEADS": heads}, path)
+
+
+def load_quantized(multitask, path, device="cpu"):
+    """Quantize a freshly built fp32 MultiTaskModel and load an int8 checkpoint written by save_quantized."""
+    quantize_int8(multitask)
+    checkpoint = torch.load(path, map_location=device, weights_only=False)
+    multitask.embedding.load_state_dict(checkpoint["MODEL_STATE"])
+    for task, layers in checkpoint["HEADS"].items():
+        # The shared embedding model is already loaded, only the head layers remain
+        for name, state in layers.items():
+            getattr(multitask.heads[task], name).load_state_dict(state)
+    return multitask.eval()
+
+
+def load_fp32(models_dir="models", device="cpu"):
+    model = NepaliTransformer(vocab_size=30000, d_model=768, num_layers=6, num_heads=8).to(device)
+    snapshot = torch.load(os.path.join(models_dir, "snapshot.pt"), map_location=device)
+    model.load_state_dict(snapshot["MODEL_STATE"])
+    nermodel = NERModel(model, hidden_dim=512, num_classes=7).to(device)
+    nermodel.load_state_dict(torch.load(os.path.join(models_dir, "NER.pt"), map_location=device))
+    posmodel = POSModel(model, hidden_dim=512, num_classes=39).to(device)
+    posmodel.load_state_dict(torch.load(os.path.join(models_dir, "POS.pt"), map_location=device))
+    return MultiTaskModel(model, {"ner": nermodel, "pos": posmodel}).eval()
+
+
+def compare(reference, candidate, tokenizer, texts, device="cpu"):
+    """Agreement of candidate with reference on NER/POS tags and fill-mask predictions."""
+    encoded = tokenizer.encode_batch(texts)
+    input_ids = encoded["input_ids"].to(device)
+    attention_mask = encoded["attention_mask"].to(device)
+    real = attention_mask.bool()
+
+    # Mask the middle token of each sentence for the fill-mask comparison
+    lengths = attention_mask.sum(dim=1)
+    masked_ids = input_ids.clone()
+    masked_ids[torch.arange(len(texts)), lengths // 2] = tokenizer.mask_token_id
+
+    results = {}
+    with torch.no_grad():
+        ref_tags = reference(input_ids, attention_mask)
+        cand_tags = candidate(input_ids, attention_mask)
+        for task in ref_tags:
+            agree = ref_tags[task].argmax(-1) == cand_tags[task].argmax(-1)
+            results[f"{task}_tag_agreement"] = agree[real].float().mean().item()
+
+        _, ref_probs, ref_top = reference.embedding.mask_predictions(masked_ids, attention_mask, tokenizer.mask_token_id)
+        _, cand_probs, cand_top = candidate.embedding.mask_predictions(masked_ids, attention_mask, tokenizer.mask_token_id)
+    results["fill_mask_top1_agreement"] = (ref_top[:, 0] == cand_top[:, 0]).float().mean().item()
+    overlap = [len(set(r) & set(c)) / len(r) for r, c in zip(ref_top.tolist(), cand_top.tolist())]
+    results["fill_mask_top5_overlap"] = sum(overlap) / len(overlap)
+    results["fill_mask_max_prob_diff"] = (ref_probs - cand_probs.float()).abs().max().item()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Produce and check reduced-precision checkpoints")
+    parser.add_argument("--models_dir", default="models", help="Directory with snapshot.pt, NER.pt and POS.pt")
+    parser.add_argument("--tokenizer", default="nepali_tokenizer.json")
+    parser.add_argument("--precision", default="int8", choices=PRECISIONS[1:])
+    parser.add_argument("--out", default=None, help="Where to write the int8 checkpoint")
+    parser.add_argument("--check", action="store_true", help="Compare outputs against fp32 and fail on regressions")
+    parser.add_argument("--texts", default=None, help="File with one sentence per line to check on")
+    parser.add_argument("--min_agreement", default=0.95, type=float, help="Lowest acceptable agreement with fp32")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() and args.precision == "bf16" else "cpu"
+    reference = load_fp32(args.models_dir, device)
+    candidate = copy.deepcopy(reference)
+    precision = apply_precision(candidate, args.precision, device)
+
+    if args.out and precision == "int8":
+        save_quantized(candidate, args.out)
+        print(f"int8 checkpoint saved at {args.out}")
+
+    if args.check:
+        tokenizer = NepaliTokenizer(load_path=args.tokenizer)
+        texts = CHECK_TEXTS
+        if args.texts:
+            with open(args.texts, encoding="utf-8") as f:
+                texts = [line.strip() for line in f if line.strip()]
+        results = compare(reference, candidate, tokenizer, texts, device)
+        for name, value in results.items():
+            print(f"{name}: {value:.4f}")
+        failed = [
+            name for name, value in results.items()
+            if name.endswith(("agreement", "overlap")) and value < args.min_agreement
+        ]
+        if failed:
+            print(f"{precision} regresses against fp32 on: {', '.join(failed)}")
+            sys.exit(1)
+        print(f"{precision} matches fp32 within {args.min_agreement:.0%} agreement")
@@ -0,0 +1,42 @@
+import sys
+import threading
+import time
+
+
+class ModelRegistry:
+    """Named objects (tokenizer, backbone, task heads) built by their loader on first use.
+
+    Each loader runs once even when several threads ask at the same time; loaders may get other
+    entries from the registry. Load times are kept for the readiness endpoint.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._locks = {}
+        self._loaded = {}
+        self.load_seconds = {}
+
+    def register(self, name, loader):
+        self._loaders[name] = loader
+        self._locks[name] = threading.Lock()
+
+    def get(self, name):
+        if name in self._loaded:
+            return self._loaded[name]
+        with self._locks[name]:
+            if name not in self._loaded:
+                start = time.perf_counter()
+                value = self._loaders[name]()
+                self.load_seconds[name] = time.perf_counter() - start
+                self._loaded[name] = value
+                print(f"Loaded {name} in {self.load_seconds[name]:.3f}s", file=sys.stderr)
+        return self._loaded[name]
+
+    def loaded(self, name):
+        return name in self._loaded
+
+    def stats(self):
+        return {
+            name: {"loaded": name in self._loaded, "load_seconds": self.load_seconds.get(name)}
+            for name in self._loaders
+        }
@@ -0,0 +1,127 @@
+"""Serve main.py from several processes that share one memory-mapped copy of the weights.
+
+    python serve.py --workers 4 --port 8000
+
+On first start (or when a checkpoint in --models_dir is newer) the backbone and both heads are
+written once as a single fp32 state dict, models/serving.weights.pt. The parent process imports
+main.py with SABDA_SHARED_WEIGHTS pointing at it and preloads every model: their parameters are
+assigned the tensors of torch.load(mmap=True), so no weights are copied. Then it opens the listening
+socket and forks the workers, which accept on that socket. A worker is ready (GET /ready) in
+milliseconds, or once its SABDA_WARMUP_LENGTHS have run, and adds almost no memory: the weights are
+clean page-cache pages mapped by every process, and the rest of the parent is shared copy-on-write.
+Workers that exit are forked again.
+
+Torch threads are split between the workers (SABDA_TORCH_THREADS), each with one inference thread
+(SABDA_INFERENCE_WORKERS=1) unless those are set already. The parent runs no inference before
+forking, so no torch thread pool is inherited half-initialised.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import torch
+
+CHECKPOINTS = ("snapshot.pt", "NER.pt", "POS.pt")
+
+
+def build_weights(models_dir, path):
+    """Write the fp32 MultiTaskModel loaded from models_dir as one state dict."""
+    from quantize import load_fp32
+
+    multitask = load_fp32(models_dir)
+    # Tensors shared between the backbone and the heads' references to it are stored once
+    torch.save(multitask.state_dict(), path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def stale(models_dir, path):
+    if not os.path.exists(path):
+        return True
+    sources = [os.path.join(models_dir, name) for name in CHECKPOINTS]
+    return any(os.path.getmtime(source) > os.path.getmtime(path) for source in sources if os.path.exists(source))
+
+
+def run_worker(app, sock):
+    import uvicorn
+
+    torch.set_num_threads(int(os.environ["SABDA_TORCH_THREADS"]))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+    server.run(sockets=[sock])
+
+
+def fork_worker(app, sock):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            run_worker(app, sock)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def supervise(app, sock, num_workers):
+    """Fork num_workers servers, replace the ones that die, stop them all on SIGINT/SIGTERM."""
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    workers = {fork_worker(app, sock) for _ in range(num_workers)}
+    print(f"Serving on {sock.getsockname()} with {num_workers} workers: {sorted(workers)}")
+    while not stopping:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid in workers:
+            workers.remove(pid)
+            workers.add(fork_worker(app, sock))
+            print(f"Worker {pid} exited, replaced")
+        time.sleep(0.2)
+
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    for pid in workers:
+        os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-process serving with shared memory-mapped weights")
+    parser.add_argument("--workers", default=2, type=int, help="Server processes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--models_dir", default="models", help="Directory with snapshot.pt, NER.pt and POS.pt")
+    parser.add_argument("--weights", default="models/serving.weights.pt", help="Shared weights file, built if missing")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the weights file even if it is up to date")
+    args = parser.parse_args()
+
+    if args.rebuild or stale(args.models_dir, args.weights):
+        print(f"Writing {args.weights} from {args.models_dir}")
+        # In a child process, so the server doesn't keep a private copy of the checkpoints
+        builder = multiprocessing.get_context("spawn").Process(target=build_weights, args=(args.models_dir, args.weights))
+        builder.start()
+        builder.join()
+        if builder.exitcode != 0:
+            raise SystemExit(f"Building {args.weights} failed")
+
+    os.environ["SABDA_SHARED_WEIGHTS"] = os.path.abspath(args.weights)
+    os.environ.setdefault("SABDA_INFERENCE_WORKERS", "1")
+    os.environ.setdefault("SABDA_TORCH_THREADS", str(max(1, (os.cpu_count() or 1) // args.workers)))
+
+    sock = socket.socket(socket.AF_INET6 if ":" in args.host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.set_inheritable(True)
+
+    import main
+
+    main.preload("all")
+    supervise(main.app, sock, args.workers)
@@ -0,0 +1,24 @@
+import importlib
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.join(BACKEND, "Training"))
+
+# main.py reads its configuration at import, which test modules importing bulk trigger at collection
+os.environ["SABDA_RANDOM_WEIGHTS"] = "1"
+os.environ["SABDA_INDEX_DIR"] = os.path.join(tempfile.mkdtemp(), "index")
+for name in ("SABDA_CACHE_DIR", "SABDA_ARTIFACT", "SABDA_SHARED_WEIGHTS", "SABDA_PRELOAD", "SABDA_WARMUP_LENGTHS"):
+    os.environ.pop(name, None)
+
+
+@pytest.fixture(scope="session")
+def main():
+    """main.py serving seeded random weights, with its search index in a temporary directory."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(BACKEND)  # main.py loads nepali_tokenizer.json from the working directory
+        yield importlib.import_module("main")
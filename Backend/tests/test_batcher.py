@@ -0,0 +1,93 @@
+import asyncio
+import threading
+
+import pytest
+
+from batcher import MicroBatcher, QueueFull
+
+
+def double(items):
+    return [item * 2 for item in items]
+
+
+def test_concurrent_submits_share_batches():
+    async def run():
+        batcher = MicroBatcher(double, max_batch_size=4, max_wait_ms=50)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+        return results, batcher.stats()
+
+    results, stats = asyncio.run(run())
+    assert results == [i * 2 for i in range(10)]
+    assert stats["total_requests"] == 10
+    assert stats["batch_size_hist"] == {2: 1, 4: 2}
+
+
+def blocked_batcher(max_pending):
+    """A batcher whose process_batch waits on the returned event, so requests pile up behind it."""
+    release = threading.Event()
+
+    def process(items):
+        release.wait()
+        return double(items)
+
+    return MicroBatcher(process, max_batch_size=1, max_wait_ms=0, max_pending=max_pending), release
+
+
+def test_submit_beyond_max_pending_raises_queue_full():
+    async def run():
+        batcher, release = blocked_batcher(max_pending=2)
+        running = asyncio.ensure_future(batcher.submit(0))
+        await asyncio.sleep(0.01)  # taken by the worker, no longer pending
+        waiting = [asyncio.ensure_future(batcher.submit(i)) for i in (1, 2)]
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            await batcher.submit(3)
+        release.set()
+        return await asyncio.gather(running, *waiting), batcher.rejected
+
+    assert asyncio.run(run()) == ([0, 2, 4], 1)
+
+
+def test_submit_many_fits_an_idle_batcher_in_chunks():
+    async def run():
+        batcher = MicroBatcher(double, max_batch_size=16, max_wait_ms=1, max_pending=8)
+        return await batcher.submit_many(list(range(30)))
+
+    assert asyncio.run(run()) == [i * 2 for i in range(30)]
+
+
+def test_submit_many_is_rejected_whole_when_busy():
+    async def run():
+        batcher, release = blocked_batcher(max_pending=4)
+        running = asyncio.ensure_future(batcher.submit(0))
+        await asyncio.sleep(0.01)
+        waiting = [asyncio.ensure_future(batcher.submit(i)) for i in (1, 2)]
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            await batcher.submit_many([3, 4, 5])
+        pending = batcher.stats()["pending"]
+        release.set()
+        await asyncio.gather(running, *waiting)
+        return pending
+
+    assert asyncio.run(run()) == 2
+
+
+@pytest.fixture
+def client(main):
+    from fastapi.testclient import TestClient
+    return TestClient(main.app)
+
+
+def test_ingest_larger_than_max_pending(main, client):
+    documents = [{"id": str(i), "text": f"राम {i} घर गए"} for i in range(main.MAX_PENDING + 44)]
+    response = client.post("/ingest", json={"documents": documents})
+    assert response.status_code == 200
+    assert response.json()["ingested"] == len(documents)
+
+
+def test_full_batcher_answers_429(main, client, monkeypatch):
+    monkeypatch.setattr(main.batchers["embed"], "max_pending", 0)
+    response = client.post("/embed", json={"texts": ["राम घर गए"]})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import bulk
+
+
+def fake_docs(lengths):
+    return [(i, str(i), "", np.zeros(length, dtype=np.int32)) for i, length in enumerate(lengths)]
+
+
+def test_length_batches_cover_every_doc_within_the_budget():
+    lengths = [5, 300, 12, 40, 40, 7, 120, 64]
+    batches = list(bulk.length_batches(fake_docs(lengths), max_tokens=256, max_batch_size=3))
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) <= 3
+        longest = max(lengths[i] for i in batch)
+        assert len(batch) == 1 or len(batch) * longest <= 256
+    # Ascending lengths, so neighbouring batches don't overlap in length
+    assert [lengths[i] for batch in batches for i in batch] == sorted(lengths)
+
+
+@pytest.fixture
+def encode(main, monkeypatch):
+    monkeypatch.setattr(bulk, "_tokenizer", main.get_tokenizer())
+    monkeypatch.setattr(bulk, "_max_length", main.MAX_DOCUMENT_TOKENS)
+    return lambda texts: bulk._encode_chunk([(seq, str(seq), text) for seq, text in enumerate(texts)])
+
+
+def test_run_batch_mixes_short_and_windowed_documents(main, encode):
+    # About 320 and 760 tokens: only the second one is past the 512 positions
+    docs = encode([" ".join(["राम घर गए ।"] * 80), " ".join(["सीता काठमाडौं गइन् ।"] * 130)])
+    assert len(docs[0][3]) <= main.MAX_LENGTH < len(docs[1][3])
+
+    mixed = bulk.run_batch(docs, ["ner", "pos", "embed"], "mean", False)
+    alone = [bulk.run_batch([doc], ["ner", "pos", "embed"], "mean", False)[0] for doc in docs]
+    for together, single in zip(mixed, alone):
+        assert together["id"] == single["id"]
+        assert together["ner"] == single["ner"]
+        assert together["pos"] == single["pos"]
+        np.testing.assert_allclose(together["embedding"], single["embedding"], atol=1e-4)
+    assert mixed[1]["pos"][-1]["end"] == len(docs[1][2])
@@ -0,0 +1,31 @@
+import torch
+
+from cache import HiddenStateCache, text_key
+
+
+def test_lru_eviction_and_disk_tier(tmp_path):
+    entry = (torch.arange(4), torch.zeros(4, 8))
+    nbytes = entry[0].to(torch.int32).nbytes + entry[1].nbytes
+    cache = HiddenStateCache(max_bytes=2 * nbytes, disk_dir=str(tmp_path), fingerprint="a")
+    for key in "xyz":
+        cache.put(key, *entry)
+    assert cache.stats()["entries"] == 2 and cache.evictions == 1
+
+    cache.clear()
+    assert torch.equal(cache.get("x")[0], entry[0].to(torch.int32))  # read back from disk
+    assert cache.disk_hits == 1
+    assert HiddenStateCache(disk_dir=str(tmp_path), fingerprint="b").get("x") is None
+
+
+def test_fingerprint_covers_document_truncation(main, monkeypatch):
+    before = main.cache_fingerprint()
+    monkeypatch.setattr(main, "MAX_DOCUMENT_TOKENS", 600)
+    assert main.cache_fingerprint() != before
+
+
+def test_entry_of_other_tokens_is_a_miss(main):
+    text = "राम घर गए ।"
+    expected = main.run_tasks([text], ["pos"])
+    # States stored for a different tokenization of the same text, e.g. under another truncation
+    main.hidden_cache.put(text_key(text), torch.arange(20), torch.zeros(20, 768))
+    assert main.run_tasks([text], ["pos"]) == expected
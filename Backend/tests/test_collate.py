@@ -0,0 +1,94 @@
+import numpy as np
+import torch
+
+from collate import MLMCollator, PackingCollator, pack_lengths
+from model import NepaliTransformer
+
+CLS, SEP, PAD, MASK = 2, 3, 0, 4
+SPECIAL = [0, 1, 2, 3, 4]
+
+
+def documents(lengths, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{"input_ids": rng.integers(5, 100, length).astype(np.uint16)} for length in lengths]
+
+
+def test_pack_lengths_first_fit_decreasing():
+    lengths = [300, 200, 100, 250, 60]
+    rows = pack_lengths(lengths, 512)
+    assert sorted(i for row in rows for i in row) == list(range(len(lengths)))
+    assert all(sum(lengths[i] for i in row) <= 512 for row in rows)
+    assert rows == [[0, 1], [3, 2, 4]]
+
+
+def test_packed_documents_keep_their_own_positions_and_segments():
+    batch = documents([100, 30, 400, 50])
+    output = PackingCollator(CLS, SEP, PAD, max_length=512)(batch)
+    input_ids, segment_ids, position_ids = output["input_ids"], output["segment_ids"], output["position_ids"]
+    assert input_ids.size(0) < len(batch)
+    assert output["token_counts"].tolist() == [588, 4 * 512, input_ids.numel()]
+
+    found = []
+    for row in range(input_ids.size(0)):
+        for segment in segment_ids[row].unique().tolist():
+            if segment == 0:
+                assert (input_ids[row][segment_ids[row] == 0] == PAD).all()
+                continue
+            ids = input_ids[row][segment_ids[row] == segment]
+            assert ids[0] == CLS and ids[-1] == SEP
+            assert position_ids[row][segment_ids[row] == segment].tolist() == list(range(len(ids)))
+            found.append(ids[1:-1].tolist())
+    assert sorted(found) == sorted(doc["input_ids"].tolist() for doc in batch)
+
+
+def test_without_packing_every_document_has_a_row():
+    output = PackingCollator(CLS, SEP, PAD, max_length=512, pack=False)(documents([10, 40]))
+    assert output["input_ids"].shape == (2, 42)
+    assert output["attention_mask"].sum(dim=1).tolist() == [12, 42]
+
+
+def test_window_with_doc_starts_is_one_row():
+    ids = np.arange(5, 25, dtype=np.uint16)
+    output = PackingCollator(CLS, SEP, PAD, max_length=32)([{"input_ids": ids, "doc_starts": np.array([8])}])
+    assert output["input_ids"][0].tolist() == [CLS, *ids.tolist(), SEP]
+    assert output["segment_ids"][0].tolist() == [1] * 9 + [2] * 13
+
+
+def test_block_diagonal_attention_matches_documents_run_alone():
+    torch.manual_seed(0)
+    model = NepaliTransformer(vocab_size=100, d_model=32, max_len=64, num_layers=2, num_heads=4).eval()
+    batch = documents([12, 7, 20])
+    packed = PackingCollator(CLS, SEP, PAD, max_length=64)(batch)
+    assert packed["input_ids"].size(0) == 1
+
+    with torch.no_grad():
+        hidden = model(packed["input_ids"], packed["attention_mask"], packed["position_ids"], packed["segment_ids"])
+        for segment in (1, 2, 3):
+            in_segment = packed["segment_ids"][0] == segment
+            ids = packed["input_ids"][0][in_segment][None]
+            alone = model(ids, torch.ones_like(ids))
+            torch.testing.assert_close(hidden[0][in_segment], alone[0], atol=1e-5, rtol=1e-4)
+
+
+def test_mlm_masking_rates():
+    torch.manual_seed(0)
+    collator = MLMCollator(MASK, vocab_size=100, special_token_ids=SPECIAL)
+    input_ids = torch.randint(5, 100, (64, 512))
+    input_ids[:, 0], input_ids[:, -1] = CLS, SEP
+    masked, labels = collator.mask_tokens(input_ids)
+
+    selected = labels != -100
+    assert not selected[:, [0, -1]].any()
+    assert torch.equal(labels[selected], input_ids[selected])
+    assert abs(selected.float().mean().item() - 0.15 * 510 / 512) < 0.005
+    as_mask = (masked[selected] == MASK).float().mean().item()
+    unchanged = (masked[selected] == input_ids[selected]).float().mean().item()
+    assert abs(as_mask - 0.8) < 0.02 and abs(unchanged - 0.1) < 0.02
+    assert torch.equal(masked[~selected], input_ids[~selected])
+    assert (masked[selected & (masked != MASK)] >= collator.first_regular_id).all()
+
+
+def test_mlm_always_selects_a_token():
+    collator = MLMCollator(MASK, vocab_size=100, special_token_ids=SPECIAL, mlm_probability=1e-9)
+    _, labels = collator.mask_tokens(torch.tensor([[CLS, 50, SEP, PAD]]))
+    assert labels.tolist() == [[-100, 50, -100, -100]]
@@ -0,0 +1,39 @@
+import json
+
+import numpy as np
+
+from dataset import PretokenizedDataset
+from pretokenize import ShardWriter
+
+
+def write_corpus(out_dir, lengths, shard_tokens=1000):
+    writer = ShardWriter(str(out_dir), shard_tokens)
+    tokens = np.arange(sum(lengths), dtype=np.uint16)
+    for start in range(0, len(lengths), 3):
+        chunk = lengths[start:start + 3]
+        first = sum(lengths[:start])
+        writer.write(tokens[first:first + sum(chunk)], np.array(chunk))
+    writer.close()
+    with open(out_dir / "index.json", "w") as f:
+        json.dump({"shards": writer.shards}, f)
+    return tokens
+
+
+def test_documents_are_read_back_truncated(tmp_path):
+    lengths = [5, 40, 12, 300, 8, 600, 20]
+    tokens = write_corpus(tmp_path, lengths)
+    dataset = PretokenizedDataset(str(tmp_path), max_length=64)
+    assert len(dataset) == len(lengths)
+    assert dataset.lengths().tolist() == [min(length, 62) for length in lengths]
+    starts = np.cumsum([0] + lengths)
+    for i, length in enumerate(lengths):
+        assert dataset[i]["input_ids"].tolist() == tokens[starts[i]:starts[i] + min(length, 62)].tolist()
+
+
+def test_packed_windows_report_documents_starting_inside(tmp_path):
+    lengths = [10, 10, 12, 20, 12]  # documents start at 0, 10, 20, 32 and 52
+    write_corpus(tmp_path, lengths)
+    dataset = PretokenizedDataset(str(tmp_path), max_length=12, packed=True)  # windows of 10 tokens
+    assert len(dataset) == 6
+    assert [dataset[i]["doc_starts"].tolist() for i in range(len(dataset))] == [[], [], [], [2], [], [2]]
+    assert dataset[3]["input_ids"].tolist() == list(range(30, 40))
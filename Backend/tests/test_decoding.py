@@ -0,0 +1,38 @@
+import numpy as np
+
+from decoding import LabelTable, bio_spans, word_spans
+
+LABELS = LabelTable({0: "O", 1: "B-LOC", 2: "B-PER", 3: "I-LOC", 4: "I-PER"})
+
+
+def test_word_spans_cover_each_words_tokens():
+    # Two rows; -1 for CLS/SEP/padding, word 1 of row 0 is split into two subwords
+    word_ids = np.array([[-1, 0, 1, 1, 2, -1], [-1, 0, -1, -1, -1, -1]])
+    offsets = np.array([
+        [[0, 0], [0, 3], [4, 6], [6, 8], [9, 11], [0, 0]],
+        [[0, 0], [0, 5], [0, 0], [0, 0], [0, 0], [0, 0]],
+    ])
+    starts, ends, mask = word_spans(word_ids, offsets)
+    assert mask.tolist() == [[True, True, True], [True, False, False]]
+    assert starts[0].tolist() == [0, 4, 9] and ends[0].tolist() == [3, 8, 11]
+    assert (starts[1, 0], ends[1, 0]) == (0, 5)
+
+
+def test_bio_spans_group_words_per_row():
+    mask = np.array([[True] * 6, [True, True, False, False, False, False]])
+    starts = np.tile(np.arange(6) * 10, (2, 1))
+    ends = starts + 5
+    predictions = np.array([
+        [1, 3, 0, 4, 2, 2],  # LOC over two words, a stray I-PER, then two separate PER
+        [4, 4, 0, 0, 0, 0],  # a span starting with I- still opens one
+    ])
+    assert bio_spans(LABELS, predictions, mask, starts, ends) == [
+        [(0, 15, "LOC"), (30, 35, "PER"), (40, 45, "PER"), (50, 55, "PER")],
+        [(0, 15, "PER")],
+    ]
+
+
+def test_span_does_not_continue_into_the_next_row():
+    mask = np.ones((2, 1), dtype=bool)
+    starts, ends = np.zeros((2, 1), dtype=np.int64), np.full((2, 1), 4)
+    assert bio_spans(LABELS, np.array([[1], [3]]), mask, starts, ends) == [[(0, 4, "LOC")], [(0, 4, "LOC")]]
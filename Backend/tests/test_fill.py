@@ -0,0 +1,24 @@
+from decoding import TokenTable
+from fill import fill_masks, get_predictions_for_masks, substitute_masks
+
+
+def test_substitute_masks_joins_continuations(main):
+    tokenizer = main.get_tokenizer()
+    table = TokenTable(tokenizer)
+    word, piece = tokenizer.tokenizer.token_to_id("राम"), table.strings.index("##को")
+    assert substitute_masks("<mask> <mask> घर", table, [word, piece]) == "रामको घर"
+
+
+def test_no_mask_returns_the_text(main):
+    text = "नेपालको काठमाडौं"
+    assert get_predictions_for_masks(main.get_model(), main.get_tokenizer(), main.device, text) == text
+    assert fill_masks(main.get_model(), main.get_tokenizer(), main.device, text) == []
+
+
+def test_iterative_fills_every_mask(main):
+    text = "<mask> घर <mask> ।"
+    filled = fill_masks(main.get_model(), main.get_tokenizer(), main.device, text, strategy="iterative", beam_size=3)
+    assert 1 <= len(filled) <= 3
+    assert all("<mask>" not in sentence for sentence, _ in filled)
+    probabilities = [probability for _, probability in filled]
+    assert probabilities == sorted(probabilities, reverse=True)
@@ -0,0 +1,23 @@
+from decoding import normalization_map, original_offsets
+
+# U+0958 (QA) is a composition exclusion: NFC decomposes it into KA + NUKTA, one character longer
+TEXT = "\u0958\u0958 राम गए"
+
+
+def test_normalization_map_points_into_original_text():
+    normalized, starts, ends = normalization_map(TEXT)
+    assert len(normalized) == len(TEXT) + 2
+    i = normalized.index("राम")
+    assert TEXT[starts[i]:ends[i + len("राम")]] == "राम"
+    assert TEXT[starts[0]:ends[2]] == "\u0958"
+
+
+def test_original_offsets_leaves_normalized_text_alone():
+    offsets = [[[0, 0], [0, 3], [4, 6], [0, 0]]]
+    assert original_offsets(["राम गए"], offsets).tolist() == offsets
+
+
+def test_pos_offsets_slice_the_text_as_sent(main):
+    tags = main.run_pos([TEXT])[0]
+    assert [tag["text"] for tag in tags] == ["\u0958\u0958", "राम", "गए"]
+    assert all(TEXT[tag["start"]:tag["end"]] == tag["text"] for tag in tags)
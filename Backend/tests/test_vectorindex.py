@@ -0,0 +1,44 @@
+import numpy as np
+
+from vectorindex import IVFIndex, unit
+
+
+def clustered(n, dim=16, clusters=8, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim))
+    return unit(centres[rng.integers(clusters, size=n)] + 0.1 * rng.normal(size=(n, dim)))
+
+
+def exact(vectors, query, k):
+    # The index stores float16 vectors, so near ties rank as they do in there
+    scores = vectors.astype(np.float16).astype(np.float32) @ unit(query)
+    return np.argsort(-scores)[:k].tolist()
+
+
+def test_exact_before_training(tmp_path):
+    vectors = clustered(50)
+    index = IVFIndex(str(tmp_path), dim=16, nlist=4, train_size=100)
+    assert index.add([str(i) for i in range(50)], [f"doc {i}" for i in range(50)], vectors) == 50
+    hits = index.search(vectors[7], k=5)[0]
+    assert [number for number, _ in hits] == exact(vectors, vectors[7], 5)
+    assert hits[0][1] > 0.999
+    assert index.document(hits[0][0]) == {"id": "7", "text": "doc 7"}
+
+
+def test_trained_lists_find_the_nearest_and_survive_reopening(tmp_path):
+    vectors = clustered(600)
+    index = IVFIndex(str(tmp_path), dim=16, nlist=8, nprobe=8, train_size=200)
+    for start in range(0, 600, 100):
+        index.add([str(i) for i in range(start, start + 100)], ["" for _ in range(100)], vectors[start:start + 100])
+    assert index.stats()["trained"]
+
+    queries = vectors[[3, 250, 599]]
+    expected = [exact(vectors, query, 10) for query in queries]
+    assert [[number for number, _ in hits] for hits in index.search(queries, k=10)] == expected
+    # Probing only the nearest list still returns the query's own document first
+    assert [hits[0][0] for hits in index.search(queries, k=1, nprobe=1)] == [3, 250, 599]
+
+    reopened = IVFIndex(str(tmp_path))
+    assert reopened.count == 600
+    assert [[number for number, _ in hits] for hits in reopened.search(queries, k=10)] == expected
+    assert reopened.document(250)["id"] == "250"
@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from windows import make_windows, stitch, window_plan
+
+
+def test_short_document_is_one_window():
+    assert window_plan(300) == [(0, 0, 300)]
+
+
+@pytest.mark.parametrize("num_tokens", [511, 763, 2000, 5119])
+def test_owned_ranges_tile_the_document(num_tokens):
+    plan = window_plan(num_tokens, max_length=512, overlap=128)
+    assert plan[0][1] == 0 and plan[-1][2] == num_tokens
+    for (start, lo, hi), (_, next_lo, _) in zip(plan, plan[1:]):
+        assert hi == next_lo
+    for start, lo, hi in plan:
+        assert 0 <= start and start + 510 <= num_tokens
+        assert start <= lo < hi <= start + 510
+        # Away from the document's ends a window never gives out its outer overlap / 2 tokens
+        assert lo == 0 or lo - start >= 64
+        assert hi == num_tokens or start + 510 - hi >= 64
+
+
+def test_overlap_must_leave_room():
+    with pytest.raises(ValueError):
+        window_plan(2000, max_length=512, overlap=510)
+
+
+def test_stitch_puts_every_token_back_in_place():
+    num_tokens = 1300
+    input_ids = torch.cat([torch.tensor([1]), torch.arange(10, 10 + num_tokens), torch.tensor([2])])
+    plan = window_plan(num_tokens, max_length=512, overlap=128)
+    windows = make_windows(input_ids, plan, cls_token_id=1, sep_token_id=2, max_length=512)
+    assert windows.shape == (len(plan), 512)
+    assert (windows[:, 0] == 1).all() and (windows[:, -1] == 2).all()
+
+    # A "model" whose hidden state is the token id itself
+    hidden = stitch(windows.float()[..., None], plan)
+    assert torch.equal(hidden[:, 0].long(), input_ids)
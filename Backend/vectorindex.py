@@ -0,0 +1,271 @@
+"""On-disk IVF (inverted file) index of sentence embeddings, memory-mapped for search.
+
+An index directory holds:
+    meta.json       dim, nlist, row count, how many rows are grouped by list, whether it is trained
+    centroids.npy   (nlist, dim) float32 unit centroids of the lists, once trained
+    vectors.f16     (count, dim) float16 unit vectors: rows grouped by list, then the unsorted tail
+    lists.i32       the list of every row
+    docs.i64        the document number of every row
+    docs.jsonl      one {"id": ..., "text": ...} line per document, in ingest order
+    offsets.i64     byte offset of every docs.jsonl line
+
+Scores are cosine similarities. A query is compared with the centroids, and only the rows of its
+nprobe nearest lists are read; those are contiguous in vectors.f16, so the page cache only holds the
+lists that are actually searched. Ingested rows are appended to the tail and merged into their lists
+once the tail outgrows compact_ratio of the grouped rows. Until train_size vectors are in, there is a
+single list and search is exact; then k-means (on unit vectors) picks the nlist centroids.
+
+Several processes can share a directory (serve.py workers): writers take an exclusive flock on
+the directory's lock file, and every process reopens the files when meta.json has changed.
+"""
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+CHUNK_ROWS = 16384  # rows converted to float32 at a time
+
+
+def unit(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def kmeans(vectors, nlist, iterations=10, seed=0):
+    """Spherical k-means: unit centroids maximising the dot product with their members."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)]
+    for _ in range(iterations):
+        assignment = nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=nlist)
+        empty = counts == 0
+        # An empty list restarts from a random vector rather than staying at zero
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = unit(sums)
+    return centroids
+
+
+def nearest(vectors, centroids):
+    """Index of the nearest centroid of every row, computed in chunks."""
+    return np.concatenate([
+        np.argmax(np.asarray(vectors[i:i + CHUNK_ROWS], dtype=np.float32) @ centroids.T, axis=1)
+        for i in range(0, len(vectors), CHUNK_ROWS)
+    ] or [np.zeros(0, dtype=np.int64)]).astype(np.int32)
+
+
+class IVFIndex:
+    """Append-only vector index with top-k cosine search.
+
+    Args:
+        directory: Index directory, created on the first add
+        dim: Vector size of a new index (an existing index keeps its own)
+        nlist: Number of lists of a new index
+        nprobe: Lists searched per query by default
+        train_size: Vectors to collect before training the lists (default 39 * nlist)
+        compact_ratio: Merge the tail into the lists once it has this fraction of the grouped rows
+    """
+
+    def __init__(self, directory, dim=768, nlist=1024, nprobe=16, train_size=None, compact_ratio=0.1):
+        self.directory = directory
+        self.nprobe = nprobe
+        self.compact_ratio = compact_ratio
+        self._lock = threading.Lock()
+        self.meta = {"dim": dim, "nlist": nlist, "count": 0, "sorted": 0, "trained": False}
+        self._meta_version = None
+        if os.path.exists(self._path("meta.json")):
+            with self._file_lock():
+                self._read_meta()
+                self._truncate()
+        self.train_size = train_size or 39 * self.meta["nlist"]
+        self._open()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def count(self):
+        return self.meta["count"]
+
+    @contextmanager
+    def _file_lock(self, exclusive=True):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path("lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _read_meta(self):
+        with open(self._path("meta.json")) as f:
+            self.meta = json.load(f)
+        self._meta_version = os.stat(self._path("meta.json")).st_mtime_ns
+
+    def _write_meta(self):
+        with open(self._path("meta.json.tmp"), "w") as f:
+            json.dump(self.meta, f)
+        os.replace(self._path("meta.json.tmp"), self._path("meta.json"))
+        self._meta_version = os.stat(self._path("meta.json")).st_mtime_ns
+
+    def _reload(self, locked=False):
+        """Reopen the files if another process has changed the index since we last looked."""
+        path = self._path("meta.json")
+        if os.path.exists(path) and os.stat(path).st_mtime_ns != self._meta_version:
+            if locked:
+                self._read_meta()
+                self._open()
+                return
+            with self._file_lock(exclusive=False):
+                self._read_meta()
+                self._open()
+
+    def _truncate(self):
+        """Drop rows written after the last meta.json update, e.g. by an interrupted add."""
+        count = self.meta["count"]
+        for name, row_bytes in (("vectors.f16", 2 * self.meta["dim"]), ("lists.i32", 4), ("docs.i64", 8), ("offsets.i64", 8)):
+            if os.path.exists(self._path(name)) and os.path.getsize(self._path(name)) > count * row_bytes:
+                os.truncate(self._path(name), count * row_bytes)
+        if count:
+            offsets = np.memmap(self._path("offsets.i64"), dtype=np.int64, mode="r")
+            with open(self._path("docs.jsonl"), "rb") as f:
+                f.seek(offsets[-1])
+                end = offsets[-1] + len(f.readline())
+            os.truncate(self._path("docs.jsonl"), end)
+
+    def _memmap(self, name, dtype, shape):
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self._path(name), dtype=dtype, mode="r", shape=shape)
+
+    def _open(self):
+        count, dim = self.meta["count"], self.meta["dim"]
+        self.vectors = self._memmap("vectors.f16", np.float16, (count, dim))
+        self.lists = self._memmap("lists.i32", np.int32, (count,))
+        self.docs = self._memmap("docs.i64", np.int64, (count,))
+        self.offsets = self._memmap("offsets.i64", np.int64, (count,))
+        if self.meta["trained"]:
+            self.centroids = np.load(self._path("centroids.npy"))
+        else:
+            self.centroids = np.zeros((1, dim), dtype=np.float32)  # one list holding everything
+        # Rows [bounds[l], bounds[l + 1]) of the grouped part belong to list l
+        self.bounds = np.searchsorted(self.lists[:self.meta["sorted"]], np.arange(len(self.centroids) + 1))
+
+    def add(self, ids, texts, vectors):
+        """Append documents and their vectors; returns the index size."""
+        vectors = unit(vectors)
+        if vectors.shape[1:] != (self.meta["dim"],):
+            raise ValueError(f"Expected vectors of size {self.meta['dim']}, got {vectors.shape[1:]}")
+        lines = [(json.dumps({"id": i, "text": t}, ensure_ascii=False) + "\n").encode("utf-8") for i, t in zip(ids, texts)]
+        with self._lock, self._file_lock():
+            self._reload(locked=True)
+            count = self.meta["count"]
+            with open(self._path("docs.jsonl"), "ab") as f:
+                start = f.tell()
+                f.write(b"".join(lines))
+            offsets = start + np.cumsum([0] + [len(line) for line in lines[:-1]], dtype=np.int64)
+            for name, array in (
+                ("vectors.f16", vectors.astype(np.float16)),
+                ("lists.i32", nearest(vectors, self.centroids) if self.meta["trained"] else np.zeros(len(vectors), np.int32)),
+                ("docs.i64", np.arange(count, count + len(vectors), dtype=np.int64)),
+                ("offsets.i64", offsets),
+            ):
+                with open(self._path(name), "ab") as f:
+                    f.write(array.tobytes())
+            self.meta["count"] = count + len(vectors)
+            self._write_meta()
+
+            if not self.meta["trained"] and self.meta["count"] >= self.train_size:
+                self._train()
+            elif self.meta["count"] - self.meta["sorted"] > self.compact_ratio * max(self.meta["sorted"], self.train_size):
+                self._compact()
+            self._open()
+            return self.meta["count"]
+
+    def _train(self):
+        self._open()
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(self.count, min(self.count, 256 * self.meta["nlist"]), replace=False))
+        centroids = kmeans(np.asarray(self.vectors[sample], dtype=np.float32), min(self.meta["nlist"], len(sample)))
+        np.save(self._path("centroids.npy"), centroids)
+        lists = np.memmap(self._path("lists.i32"), dtype=np.int32, mode="r+", shape=(self.count,))
+        lists[:] = nearest(self.vectors, centroids)
+        lists.flush()
+        del lists
+        self.meta["trained"] = True
+        self._compact()
+
+    def _compact(self):
+        """Rewrite the rows grouped by list (stable, so ingest order is kept within a list)."""
+        self._open()
+        order = np.argsort(self.lists, kind="stable")
+        for name, source in (("vectors.f16", self.vectors), ("lists.i32", self.lists), ("docs.i64", self.docs)):
+            target = np.memmap(self._path(name + ".tmp"), dtype=source.dtype, mode="w+", shape=source.shape)
+            for i in range(0, len(order), CHUNK_ROWS):
+                target[i:i + CHUNK_ROWS] = source[order[i:i + CHUNK_ROWS]]
+            target.flush()
+            del target
+        for name in ("vectors.f16", "lists.i32", "docs.i64"):
+            os.replace(self._path(name + ".tmp"), self._path(name))
+        self.meta["sorted"] = self.meta["count"]
+        self._write_meta()
+
+    def search(self, queries, k=10, nprobe=None):
+        """Top-k (document number, score) pairs per query, best first."""
+        queries = unit(np.atleast_2d(queries))
+        with self._lock:
+            self._reload()
+            vectors, lists, docs, centroids, bounds = self.vectors, self.lists, self.docs, self.centroids, self.bounds
+            num_sorted = self.meta["sorted"]
+        nprobe = min(nprobe or self.nprobe, len(centroids))
+        probes = np.argsort(-(queries @ centroids.T), axis=1)[:, :nprobe]
+
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+        def merge(query_rows, rows, scores):
+            # scores: (len(query_rows), len(rows)); keeps the k best per query
+            nonlocal best_scores, best_rows
+            width = max(best_scores.shape[1], min(k, best_scores.shape[1] + len(rows)))
+            if width > best_scores.shape[1]:
+                pad = width - best_scores.shape[1]
+                best_scores = np.pad(best_scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+                best_rows = np.pad(best_rows, ((0, 0), (0, pad)), constant_values=-1)
+            all_scores = np.concatenate([best_scores[query_rows], scores], axis=1)
+            all_rows = np.concatenate([best_rows[query_rows], np.broadcast_to(rows, scores.shape)], axis=1)
+            top = np.argpartition(-all_scores, width - 1, axis=1)[:, :width]
+            best_scores[query_rows] = np.take_along_axis(all_scores, top, axis=1)
+            best_rows[query_rows] = np.take_along_axis(all_rows, top, axis=1)
+
+        for list_id in np.unique(probes):
+            query_rows = np.flatnonzero((probes == list_id).any(axis=1))
+            for start in range(bounds[list_id], bounds[list_id + 1], CHUNK_ROWS):
+                stop = min(start + CHUNK_ROWS, bounds[list_id + 1])
+                scores = queries[query_rows] @ np.asarray(vectors[start:stop], dtype=np.float32).T
+                merge(query_rows, np.arange(start, stop), scores)
+
+        tail_lists = np.asarray(lists[num_sorted:])
+        for query_row, probe in enumerate(probes):
+            tail_rows = num_sorted + np.flatnonzero(np.isin(tail_lists, probe))
+            for i in range(0, len(tail_rows), CHUNK_ROWS):
+                rows = tail_rows[i:i + CHUNK_ROWS]
+                scores = np.asarray(vectors[rows], dtype=np.float32) @ queries[query_row]
+                merge(np.array([query_row]), rows, scores[None])
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [
+            [(int(docs[row]), float(score)) for row, score in zip(rows, scores) if row >= 0]
+            for rows, scores in zip(best_rows, best_scores)
+        ]
+
+    def document(self, number):
+        """The {"id", "text"} record of a document number returned by search."""
+        with open(self._path("docs.jsonl"), "rb") as f:
+            f.seek(int(self.offsets[number]))
+            return json.loads(f.readline())
+
+    def stats(self):
+        return {**self.meta, "tail": self.meta["count"] - self.meta["sorted"], "nprobe": self.nprobe}
@@ -0,0 +1,49 @@
+"""Overlapping windows for documents longer than the model's 512 positions.
+
+A document's tokens (without CLS/SEP) are cut into windows of max_length - 2 tokens that overlap by
+`overlap` tokens; every window gets its own CLS/SEP and all windows run as one batch. Each token's
+hidden state is then taken from the window in which it sits closest to the centre: the overlap between
+two neighbouring windows is split in the middle, so no token is used from the first or last
+overlap / 2 positions of a window (except at the document's own start and end).
+"""
+import torch
+
+
+def window_plan(num_tokens, max_length=512, overlap=128):
+    """(start, lo, hi) per window, in content token positions.
+
+    The window covers tokens [start, start + max_length - 2) and owns [lo, hi) of them; the owned
+    ranges tile [0, num_tokens) exactly.
+    """
+    size = max_length - 2
+    if num_tokens <= size:
+        return [(0, 0, num_tokens)]
+    if not 0 <= overlap < size:
+        raise ValueError(f"overlap must be in [0, {size}), got {overlap}")
+    step = size - overlap
+    starts = list(range(0, num_tokens - size, step)) + [num_tokens - size]  # the last window ends at the end
+    bounds = [0] + [(next_start + start + size) // 2 for start, next_start in zip(starts, starts[1:])] + [num_tokens]
+    return [(start, lo, hi) for start, lo, hi in zip(starts, bounds[:-1], bounds[1:])]
+
+
+def make_windows(input_ids, plan, cls_token_id, sep_token_id, max_length=512):
+    """Batch of windows (num_windows, max_length) from one document's ids including its CLS/SEP."""
+    content = input_ids[1:-1]
+    size = max_length - 2
+    windows = torch.empty((len(plan), max_length), dtype=input_ids.dtype)
+    windows[:, 0] = cls_token_id
+    windows[:, -1] = sep_token_id
+    for row, (start, _, _) in enumerate(plan):
+        windows[row, 1:-1] = content[start:start + size]
+    return windows
+
+
+def stitch(window_hidden, plan):
+    """Hidden states of the whole document (num_tokens + 2, d_model) from the windows' hidden states."""
+    num_tokens = plan[-1][2]
+    hidden = window_hidden.new_empty((num_tokens + 2, window_hidden.size(-1)))
+    hidden[0] = window_hidden[0, 0]  # CLS of the first window
+    hidden[-1] = window_hidden[-1, -1]  # SEP of the last window
+    for row, (start, lo, hi) in enumerate(plan):
+        hidden[1 + lo:1 + hi] = window_hidden[row, 1 + lo - start:1 + hi - start]
+    return hidden
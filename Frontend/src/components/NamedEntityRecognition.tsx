@@ -4,6 +4,8 @@ import axios from 'axios';
 type Entity = {
     text: string;
     type: string;
+    start?: number;
+    end?: number;
 };
 
 interface LanguageText {
@@ -28,6 +30,9 @@ const entityColors: { [key: string]: string } = {
     'I-LOC': 'bg-lime-200 text-lime-900 border-lime-300',      // Inside Location
     'I-PER': 'bg-pink-200 text-pink-900 border-pink-300',        // Inside Person
     'I-ORG': 'bg-teal-200 text-teal-900 border-teal-300',      // Inside Organization
+    'LOC': 'bg-green-200 text-green-900 border-green-300',      // Location span
+    'PER': 'bg-purple-200 text-purple-900 border-purple-300',    // Person span
+    'ORG': 'bg-yellow-200 text-yellow-900 border-yellow-300',    // Organization span
 };
 
 const entityDescriptions: Record<string, { en: string, ne: string }> = {
@@ -38,6 +43,9 @@ const entityDescriptions: Record<string, { en: string, ne: string }> = {
     'I-LOC': { en: 'Inside Location', ne: 'स्थानको अन्तर्गत' },
     'I-PER': { en: 'Inside Person', ne: 'व्यक्तिको अन्तर्गत' },
     'I-ORG': { en: 'Inside Organization', ne: 'संस्थाको अन्तर्गत' },
+    'LOC': { en: 'Location', ne: 'स्थान' },
+    'PER': { en: 'Person', ne: 'व्यक्ति' },
+    'ORG': { en: 'Organization', ne: 'संस्था' },
 };
 
 interface NamedEntityRecognitionProps {
@@ -144,8 +152,9 @@ const NamedEntityRecognition: React.FC<NamedEntityRecognitionProps> = ({ isNepal
         const parts = [];
 
         entities.forEach((entity, index) => {
-            const entityStart = text.indexOf(entity.text, lastIndex);
-            const entityEnd = entityStart + entity.text.length;
+            // Character offsets from the API when present, otherwise search for the entity text
+            const entityStart = entity.start ?? text.indexOf(entity.text, lastIndex);
+            const entityEnd = entity.end ?? entityStart + entity.text.length;
 
             if (entityStart === -1) {
                 return;